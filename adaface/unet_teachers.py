@@ -66,6 +66,13 @@ class UNetTeacher(nn.Module):
                 global_t_lb=0, global_t_ub=1000):
         assert num_denoising_steps <= 10
 
+        # The caller always passes teacher_context as a list (or tuple) of contexts, one per unet.
+        # A single-unet teacher takes the only context out of the list, 
+        # so that the caller doesn't need to branch on the number of teachers.
+        if self.name != 'unet_ensemble' and isinstance(teacher_context, (list, tuple)):
+            assert len(teacher_context) == 1, f"{self.name} teacher expects 1 context, got {len(teacher_context)}."
+            teacher_context = teacher_context[0]
+
         if self.p_uses_cfg > 0:
             self.uses_cfg = np.random.rand() < self.p_uses_cfg
             if self.uses_cfg:
@@ -115,7 +122,8 @@ class UNetTeacher(nn.Module):
         if same_t_noise_across_instances:
             # If same_t_noise_across_instances, we use the same t and noise for all instances.
             t = t[0].repeat(x_start.shape[0])
-            noise = noise[:1].repeat(x_start.shape[0], 1, 1, 1)
+            # noise is only read by q_sample(), so an expanded view is enough.
+            noise = noise[:1].expand(x_start.shape[0], -1, -1, -1)
 
         # Initially, x_starts only contains the original x_start.
         x_starts    = [ x_start ]
@@ -178,12 +186,13 @@ class UNetTeacher(nn.Module):
                     t_ub = torch.clamp(t_ub, max=global_t_ub)
                     earlier_timesteps = (t_ub - t_lb) * relative_ts + t_lb
                     earlier_timesteps = earlier_timesteps.long()
-                    noise = torch.randn_like(pred_x0)
-
                     if same_t_noise_across_instances:
                         # If same_t_noise_across_instances, we use the same earlier_timesteps and noise for all instances.
+                        # Only one instance of noise is sampled, and expanded to the whole batch.
                         earlier_timesteps = earlier_timesteps[0].repeat(x_start.shape[0])
-                        noise = noise[:1].repeat(x_start.shape[0], 1, 1, 1)
+                        noise = torch.randn_like(pred_x0[:1]).expand(x_start.shape[0], -1, -1, -1)
+                    else:
+                        noise = torch.randn_like(pred_x0)
 
                     # earlier_timesteps = ts[i+1] < ts[i].
                     ts.append(earlier_timesteps)
@@ -212,6 +221,23 @@ class UNetTeacher(nn.Module):
 
         return teacher_context
 
+    # Compile the teacher unet(s) in place with torch.compile. 
+    # The teacher is frozen and called with plain diffusers arguments, so it compiles cleanly.
+    # Module.compile() keeps the module hierarchy and state_dict keys unchanged.
+    # dynamic: whether the input shapes (batch sizes) may vary across calls.
+    def compile_unets(self, dynamic=False):
+        if self.name == 'unet_ensemble':
+            # UNetEnsemble contains a list of unets, and mixes their outputs.
+            # With cls_subj_mix_scheme == 'unet', the same unet may appear more than once.
+            # Compile each distinct unet only once.
+            unets = list({ id(unet): unet for unet in self.unet.unets }.values())
+        else:
+            unets = [ self.unet ]
+
+        for unet in unets:
+            unet.compile(dynamic=dynamic)
+        print(f"Compiled {len(unets)} unet(s) of {self.name} teacher, dynamic={dynamic}.")
+
 class Arc2FaceTeacher(UNetTeacher):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -54,11 +54,13 @@ class FacialAreaRegion:
         self.confidence  = confidence
 
 class RetinaFaceClient(nn.Module):
-    def __init__(self, device='cuda'):
+    # use_fp16: run the detector under float16 autocast. The weights are kept in float32.
+    def __init__(self, device='cuda', use_fp16=False):
         super(RetinaFaceClient, self).__init__()
         # We have called torch.cuda.set_device(opt.gpu) in stable_txt2img.py, so to("cuda") 
         # will put the model on the correct GPU.
         self.model = get_model("biubug6", max_size=1024, device=device)
+        self.use_fp16 = use_fp16
 
     def detect_faces(self, img: np.ndarray, T=20) -> List[FacialAreaRegion]:
         """
@@ -74,7 +76,8 @@ class RetinaFaceClient(nn.Module):
         resp = []
 
         # predict_jsons is wrapped with torch.no_grad().
-        objs = self.model.predict_jsons(img, confidence_threshold=0.9)
+        with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=self.use_fp16):
+            objs = self.model.predict_jsons(img, confidence_threshold=0.9)
         H, W = img.shape[:2]
 
         '''
@@ -14,11 +14,12 @@ from diffusers import UNet2DConditionModel, StableDiffusionPipeline, Autoencoder
 from ldm.util import    exists, default, instantiate_from_config, disabled_train, \
                         calc_prompt_emb_delta_loss, calc_comp_subj_bg_preserve_loss, calc_recon_loss, \
                         calc_recon_and_suppress_losses, calc_attn_norm_loss, calc_subj_comp_rep_distill_loss, \
-                        calc_subj_masked_bg_suppress_loss, save_grid, gen_smooth_grad_layer, \
+                        calc_subj_masked_bg_suppress_loss, save_grid_sync, gen_smooth_grad_layer, \
                         distribute_embedding_to_M_tokens_by_dict, join_dict_of_indices_with_key_filter, \
                         collate_dicts, select_and_repeat_instances, halve_token_indices, \
                         merge_cls_token_embeddings, anneal_perturb_embedding, calc_dyn_loss_scale, \
-                        count_optimized_params, count_params, torch_uniform, pixel_bboxes_to_latent
+                        count_optimized_params, count_params, torch_uniform, pixel_bboxes_to_latent, \
+                        bboxes_to_mask
                         
 from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
 from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor
@@ -39,7 +40,7 @@ from ldm.modules.arcface_wrapper import ArcFaceWrapper
 from evaluation.clip_eval import CLIPEvaluator
 
 import sys
-import asyncio
+from concurrent.futures import ThreadPoolExecutor
 torch.set_printoptions(precision=4, sci_mode=False)
 
 import platform
@@ -56,6 +57,15 @@ if arch != "arm64" and arch != "aarch64":
 else:
     print("Skipping bitsandbytes import on arm64 architecture.")
 
+# The losses logged by calc_comp_subj_bg_preserve_loss() during comp feat distillation.
+# They are logged as f'{session_prefix}/{loss_name}', with the 'loss_' prefix removed.
+COMP_FEAT_DISTILL_LOSS_NAMES = ( 'loss_sc_recon_ssfg_attn_agg', 'loss_sc_recon_ssfg_flow', 'loss_sc_recon_ssfg_min', 
+                                 'loss_sc_recon_mc_attn_agg',   'loss_sc_recon_mc_flow',   'loss_sc_recon_mc_sameloc', 'loss_sc_recon_mc_min',
+                                 'loss_sc_to_ssfg_sparse_attns_distill', 'loss_sc_to_mc_sparse_attns_distill',
+                                 'loss_comp_subj_bg_attn_suppress', 
+                                 'ssfg_flow_win_rate', 'mc_flow_win_rate', 'mc_sameloc_win_rate',
+                                 'ssfg_avg_sparse_distill_weight', 'mc_avg_sparse_distill_weight' )
+
 class DDPM(pl.LightningModule):
     # classic DDPM with Gaussian diffusion, in image space
     def __init__(self,
@@ -121,6 +131,12 @@ class DDPM(pl.LightningModule):
                  # so that the subject attention is more concentrated takes up a smaller area.
                  sc_subj_attn_var_shrink_factor=3.,
                  res_hidden_states_stopgrad=True,
+                 # Compile the frozen unet teacher and the comp distillation priming unet 
+                 # with torch.compile. The student unet is not compiled, as its attn processors
+                 # toggle LoRAs and capture activations on a per-call basis.
+                 compile_frozen_unets=False,
+                 # Decode and cache the generated images for logging every n iterations.
+                 log_generations_every_n_iters=1,
                 ):
         
         super().__init__()
@@ -201,6 +217,8 @@ class DDPM(pl.LightningModule):
         self.p_shrink_subj_attn     = p_shrink_subj_attn
         self.sc_subj_attn_var_shrink_factor = sc_subj_attn_var_shrink_factor
         self.res_hidden_states_stopgrad = res_hidden_states_stopgrad
+        self.compile_frozen_unets   = compile_frozen_unets
+        self.log_generations_every_n_iters = log_generations_every_n_iters
 
         if self.use_ldm_unet:
             self.model = DiffusionWrapper(unet_config)
@@ -501,6 +519,15 @@ class LatentDiffusion(DDPM):
                                                     unet_weights_in_ensemble=None,
                                                     p_uses_cfg=self.p_unet_teacher_uses_cfg,
                                                     cfg_scale_range=self.unet_teacher_cfg_scale_range)
+            if self.compile_frozen_unets:
+                # The batch size fed to the teacher varies (with/without CFG, 
+                # with/without comp prompts), so the teacher is compiled with dynamic shapes.
+                self.unet_teacher.compile_unets(dynamic=True)
+            # Map each teacher type to the index of its ID prompt embeddings in id2img_prompt_embs.
+            # If id2ada_prompt_encoder.name == 'jointIDs', the img_prompt_embs are ordered as 
+            # consistentID, arc2face. Otherwise, there's a single encoder.
+            self.joint_encoder_name2idx  = { 'consistentID': 0, 'arc2face': 1 }
+            self.single_encoder_name2idx = { self.unet_teacher_types[0]: 0 }
         else:
             self.unet_teacher = None
 
@@ -536,6 +563,11 @@ class LatentDiffusion(DDPM):
                                     cfg_scale_range=[2, 4],
                                     torch_dtype=torch.float16)             
             self.comp_distill_priming_unet.train = disabled_train
+            if self.compile_frozen_unets:
+                # The priming unet is called on x_start_1 (1 instance) and then on x_start_2 
+                # (2 instances), and p_uses_cfg=1 doubles each batch. So it's also compiled 
+                # with dynamic shapes, to avoid recompiling for each batch size.
+                self.comp_distill_priming_unet.compile_unets(dynamic=True)
 
         # cond_stage_model = FrozenCLIPEmbedder training = False.
         # We never train the CLIP text encoder. So disable the training of the CLIP text encoder.
@@ -603,6 +635,14 @@ class LatentDiffusion(DDPM):
         self.generation_cache_img_colors = []
         self.cache_start_iter = 0
         self.num_cached_generations = 0
+        # The grid saver thread is created lazily on rank 0 in cache_and_log_generations().
+        self.save_grid_executor = None
+        self.save_grid_future   = None
+        # The UNet checkpoint writer thread is created lazily in on_save_checkpoint().
+        self.save_ckpt_executor = None
+        self.save_ckpt_future   = None
+        # session_prefix -> the logging keys of COMP_FEAT_DISTILL_LOSS_NAMES.
+        self.comp_feat_distill_log_keys = {}
 
     @torch.no_grad()
     def on_train_batch_start(self, batch, batch_idx):
@@ -839,7 +879,11 @@ class LatentDiffusion(DDPM):
             z = 1. / self.scale_factor * z
             # first_stage_model: ldm.models.autoencoder.AutoencoderKL
             #LINK ldm/models/autoencoder.py#AutoencoderKL_decode
-            return self.first_stage_model.decode(z)
+            # The LDM VAE is in float32. Since no gradients are needed here, 
+            # decode under float16 autocast, just like the float16 diffusers VAE below.
+            with torch.autocast(device_type='cuda', dtype=torch.float16):
+                image = self.first_stage_model.decode(z)
+            return image.float()
         else:
             # Revised from StableDiffusionPipeline::decode_latents().
             z = z.to(self.model.pipeline.dtype)
@@ -1025,7 +1069,7 @@ class LatentDiffusion(DDPM):
         # do_unet_distill and random() < unet_distill_iter_gap.
         # p_gen_rand_id_for_id2img: 0.4 if distilling on arc2face. 0.2 if distilling on consistentID,
         # 0.1 if distilling on jointIDs.
-        if self.iter_flags['do_unet_distill'] and (torch.rand(1) < self.p_gen_rand_id_for_id2img):
+        if self.iter_flags['do_unet_distill'] and (torch.rand(1) < self.p_gen_rand_id_for_id2img).item():
             self.iter_flags['gen_rand_id_for_id2img'] = True
             self.batch_subject_names = [ "rand_id_to_img_prompt" ] * len(batch['subject_name'])
         else:
@@ -1159,7 +1203,7 @@ class LatentDiffusion(DDPM):
 
         if self.iter_flags['recon_on_comp_prompt']:
             captions = subj_comp_prompts
-        elif self.iter_flags['do_unet_distill'] and (torch.rand(1) < self.p_unet_distill_uses_comp_prompt):
+        elif self.iter_flags['do_unet_distill'] and (torch.rand(1) < self.p_unet_distill_uses_comp_prompt).item():
             # Sometimes we use the subject compositional instances as the distillation target on a UNet ensemble teacher.
             # If unet_teacher_types == ['arc2face'], then p_unet_distill_uses_comp_prompt == 0, i.e., we
             # never use the compositional instances as the distillation target of arc2face.
@@ -1364,6 +1408,17 @@ class LatentDiffusion(DDPM):
         
         extra_info['placeholder2indices_1b'] = placeholder2indices_1b
         extra_info['placeholder2indices_2b'] = placeholder2indices_2b
+        # Join the subject indices once per iteration, and cache them in extra_info.
+        # all_subj_indices_1b / _2b are used to extract the attention weights
+        # of the subject tokens for the attention loss computation in p_losses().
+        # self.embedding_manager.subject_string_dict: the key filter list. Only contains 'z' 
+        # when each image contains a single subject.
+        extra_info['all_subj_indices_1b'] = \
+            join_dict_of_indices_with_key_filter(placeholder2indices_1b,
+                                                 self.embedding_manager.subject_string_dict)
+        extra_info['all_subj_indices_2b'] = \
+            join_dict_of_indices_with_key_filter(placeholder2indices_2b,
+                                                 self.embedding_manager.subject_string_dict)
 
         # cls_single_emb and cls_comp_emb have been patched above. 
         # Then combine them back into prompt_emb_4b_orig.
@@ -1385,13 +1440,14 @@ class LatentDiffusion(DDPM):
             prompt_in = subj_single_prompts + subj_comp_prompts + subj_comp_rep_prompts + cls_comp_prompts
 
             # Mix 0.2 of the subject comp embeddings with 0.8 of the cls comp embeddings as cls_comp_emb2.
-            cls_comp_emb2      = subj_comp_emb * (1 - self.cls_subj_mix_ratio) + cls_comp_emb      * self.cls_subj_mix_ratio
+            # torch.lerp(a, b, w) = a * (1 - w) + b * w, computed in a single fused kernel.
+            cls_comp_emb2      = torch.lerp(subj_comp_emb, cls_comp_emb,      self.cls_subj_mix_ratio)
             # if cls_subj_mix_ratio == 0.8, then reverse_mix_ratio == 0.9.
             reverse_mix_ratio  = 0.5 + self.cls_subj_mix_ratio / 2
             # Mix 0.2 of the cls comp embeddings with 0.8 of the subject comp embeddings as subj_comp_emb2.
-            subj_comp_emb2     = cls_comp_emb  * (1 - reverse_mix_ratio)       + subj_comp_emb     * reverse_mix_ratio
+            subj_comp_emb2     = torch.lerp(cls_comp_emb,  subj_comp_emb,     reverse_mix_ratio)
             # Mix 0.2 of the cls comp embeddings with 0.8 of the subject comp rep embeddings as subj_comp_rep_emb2.
-            subj_comp_rep_emb2 = cls_comp_emb  * (1 - reverse_mix_ratio)       + subj_comp_rep_emb * reverse_mix_ratio
+            subj_comp_rep_emb2 = torch.lerp(cls_comp_emb,  subj_comp_rep_emb, reverse_mix_ratio)
             prompt_emb = torch.cat([subj_single_emb, subj_comp_emb2, subj_comp_rep_emb2, cls_comp_emb2], dim=0)
             
             # Update the cls_single (mc) embedding mask and padding mask to be those of sc_rep.
@@ -1405,6 +1461,7 @@ class LatentDiffusion(DDPM):
             # The prompts are either (subj single, subj comp, cls single, cls comp).
             # So the first 2 sub-blocks always contain the subject tokens, and we use *_2b.    
             extra_info['placeholder2indices'] = extra_info['placeholder2indices_2b']
+            extra_info['all_subj_indices']    = extra_info['all_subj_indices_2b']
         else:
             # do_normal_recon or do_unet_distill.
             prompt_in = captions
@@ -1422,6 +1479,7 @@ class LatentDiffusion(DDPM):
             # The blocks as input to get_text_conditioning() are not halved. 
             # So BLOCK_SIZE = ORIG_BS = 2. Therefore, for the two instances, we use *_1b.
             extra_info['placeholder2indices'] = extra_info['placeholder2indices_1b']
+            extra_info['all_subj_indices']    = extra_info['all_subj_indices_1b']
                             
         # extra_info['cls_single_emb'] and extra_info['cls_comp_emb'] are used in unet distillation.
         # cls_comp_emb is only mixed in do_comp_feat_distill iterations, so it's fine.
@@ -1459,6 +1517,10 @@ class LatentDiffusion(DDPM):
         prompt_emb_ = prompt_emb[slice_inst]
         prompt_in_  = prompt_in[slice_inst]
         cond_context_ = (prompt_emb_, prompt_in_, extra_info)
+        # NOTE: we don't use torch.inference_mode() on the no-grad slices. The activations captured 
+        # on these slices are later combined with those of the grad-enabled sc slice in the 
+        # distillation losses, and inference tensors cannot be saved for backward.
+        # Under torch.no_grad(), no computation graph is kept for these slices anyway.
         with torch.set_grad_enabled(enable_grad):
             # use_attn_lora and use_ffn_lora are set in apply_model().
             noise_pred = self.apply_model(x_noisy_, t_, cond_context_, 
@@ -1508,61 +1570,64 @@ class LatentDiffusion(DDPM):
         elif batch_part_has_grad == 'subject-compos':
             # Although use_attn_lora is set to True, if self.unet_uses_attn_lora is False, it will be overridden
             # in the unet.
-            extra_info_ss = copy.copy(extra_info)
-            extra_info_ss['subj_indices']       = subj_indices
-            extra_info_ss['shrink_subj_attn']   = shrink_subj_attn
-            cond_context2 = (cond_context[0], cond_context[1], extra_info_ss)
-            noise_pred_ss = self.sliced_apply_model(x_noisy, t, cond_context2, slice_inst=slice(0, 1), 
+            # Only two variants of extra_info are needed: the ss, sc (and ms when it's actually sc_comp_rep)
+            # instances share the same subj_indices and shrink_subj_attn, and the mc instance has none of them.
+            # NOTE: the unet writes 'ca_layers_activations' into the extra_info passed to it,
+            # so we fetch it right after each call, before the dict is reused by the next slice.
+            extra_info_subj   = { **extra_info, 'subj_indices':     subj_indices,
+                                                 'shrink_subj_attn': shrink_subj_attn }
+            extra_info_nosubj = { **extra_info, 'subj_indices':     None,
+                                                 'shrink_subj_attn': False }
+            cond_context_subj   = (cond_context[0], cond_context[1], extra_info_subj)
+            cond_context_nosubj = (cond_context[0], cond_context[1], extra_info_nosubj)
+
+            noise_pred_ss = self.sliced_apply_model(x_noisy, t, cond_context_subj, slice_inst=slice(0, 1), 
                                                       enable_grad=False, use_attn_lora=use_attn_lora,
                                                       use_ffn_lora=use_ffn_lora)
-            extra_info_sc = copy.copy(extra_info)
-            extra_info_sc['subj_indices']       = subj_indices
-            extra_info_sc['shrink_subj_attn']   = shrink_subj_attn
-            cond_context2 = (cond_context[0], cond_context[1], extra_info_sc)
-            noise_pred_sc = self.sliced_apply_model(x_noisy, t, cond_context2, slice_inst=slice(1, 2),
+            ca_layers_activations_ss = extra_info_subj.get('ca_layers_activations')
+            noise_pred_sc = self.sliced_apply_model(x_noisy, t, cond_context_subj, slice_inst=slice(1, 2),
                                                       enable_grad=True,  use_attn_lora=use_attn_lora,
                                                       use_ffn_lora=use_ffn_lora)
+            ca_layers_activations_sc = extra_info_subj.get('ca_layers_activations')
             ## Enable attn LoRAs on class instances, since we also do sc-mc matching using the corresponding q's.
             # Revert to always disable attn LoRAs on class instances to avoid degeneration.
-            extra_info_ms = copy.copy(extra_info)
             if subj_comp_distill_on_rep_prompts:
                 # The ms instance is actually sc_comp_rep.
                 # So we use the same subj_indices and shrink_subj_attn as the sc instance.
-                extra_info_ms['subj_indices']       = subj_indices
-                extra_info_ms['shrink_subj_attn']   = shrink_subj_attn
+                extra_info_ms     = extra_info_subj
+                cond_context_ms   = cond_context_subj
                 mc_uses_attn_lora = use_attn_lora
                 mc_uses_ffn_lora  = use_ffn_lora
             else:
                 # The mc instance is indeed mc.
                 # We never need to suppress the subject attention in the mc instances, nor do we apply LoRAs.
                 # NOTE: currently the mc instance is not in use. So how these values are set doesn't really matter.
-                extra_info_ms['subj_indices']       = None
-                extra_info_ms['shrink_subj_attn']   = False
+                extra_info_ms     = extra_info_nosubj
+                cond_context_ms   = cond_context_nosubj
                 mc_uses_attn_lora = False
                 mc_uses_ffn_lora  = False
 
-            cond_context2 = (cond_context[0], cond_context[1], extra_info_ms)
-            noise_pred_ms = self.sliced_apply_model(x_noisy, t, cond_context2, slice_inst=slice(2, 3),
+            noise_pred_ms = self.sliced_apply_model(x_noisy, t, cond_context_ms, slice_inst=slice(2, 3),
                                                       enable_grad=False, use_attn_lora=mc_uses_attn_lora, 
                                                       use_ffn_lora=mc_uses_ffn_lora)
+            ca_layers_activations_ms = extra_info_ms.get('ca_layers_activations')
             
-            extra_info_mc = copy.copy(extra_info)
-            extra_info_mc['subj_indices']       = None
-            extra_info_mc['shrink_subj_attn']   = False
-            cond_context2 = (cond_context[0], cond_context[1], extra_info_mc)
             # Never use attn LoRAs and ffn LoRAs on mc instances.
-            noise_pred_mc = self.sliced_apply_model(x_noisy, t, cond_context2, slice_inst=slice(3, 4),
+            noise_pred_mc = self.sliced_apply_model(x_noisy, t, cond_context_nosubj, slice_inst=slice(3, 4),
                                                       enable_grad=False, use_attn_lora=False,
                                                       use_ffn_lora=False)
+            ca_layers_activations_mc = extra_info_nosubj.get('ca_layers_activations')
 
             noise_pred = torch.cat([noise_pred_ss, noise_pred_sc, noise_pred_ms, noise_pred_mc], dim=0)
+            # Release the sliced outputs right away, as they have been copied into noise_pred.
+            del noise_pred_ss, noise_pred_sc, noise_pred_ms, noise_pred_mc
             extra_info = cond_context[2]
             if capture_ca_activations:
                 # Collate three captured activation dicts into extra_info.
-                ca_layers_activations = collate_dicts([extra_info_ss['ca_layers_activations'],
-                                                       extra_info_sc['ca_layers_activations'],
-                                                       extra_info_ms['ca_layers_activations'],
-                                                       extra_info_mc['ca_layers_activations']])
+                ca_layers_activations = collate_dicts([ca_layers_activations_ss,
+                                                       ca_layers_activations_sc,
+                                                       ca_layers_activations_ms,
+                                                       ca_layers_activations_mc])
         else:
             breakpoint()
 
@@ -1574,7 +1639,9 @@ class LatentDiffusion(DDPM):
                 # uncond_context is a tuple of (uncond_emb, uncond_prompt_in, extra_info).
                 # By default, 'capture_ca_activations' = False in a generated text context, 
                 # including uncond_context. So we don't need to set it in self.uncond_context explicitly.                
-                uncond_emb  = self.uncond_context[0].repeat(x_noisy.shape[0], 1, 1)
+                # uncond_emb is read-only, so expand() suffices and avoids allocating a new tensor
+                # at every call. The UNet wrapper makes a (contiguous) copy when casting it to fp16.
+                uncond_emb  = self.uncond_context[0].expand(x_noisy.shape[0], -1, -1)
 
             uncond_prompt_in = self.uncond_context[1] * x_noisy.shape[0]
             uncond_context = (uncond_emb, uncond_prompt_in, self.uncond_context[2])
@@ -1691,7 +1758,9 @@ class LatentDiffusion(DDPM):
                         # adv_grad is effectively subtracted from x_start, minimizing the face embedding magnitudes.
                         # We predict the updated noise to remain consistent with the training paradigm.
                         # Q: should we subtract adv_grad from x_start instead of noise? I'm not sure.
-                        noise[:FACELOSS_BS] -= adv_grad
+                        # adv_grad is x_start.grad, which has no grad_fn. Match the dtype of noise 
+                        # to avoid an implicit type promotion in the in-place subtraction.
+                        noise[:FACELOSS_BS].sub_(adv_grad.to(noise.dtype))
 
                         self.adaface_adv_success_iters_count += 1
                         # adaface_adv_success_rate is always close to 1, so we don't monitor it.
@@ -1708,8 +1777,11 @@ class LatentDiffusion(DDPM):
         assert num_denoising_steps <= 10
 
         # Use the same t and noise for all instances.
+        # noise is only read by q_sample() in guided_denoise(). So if BLOCK_SIZE == 1, 
+        # it's an expanded view of the first block, instead of 4 copies.
+        BLOCK_SIZE = x_start.shape[0] // 4
         t     = t.chunk(4)[0].repeat(4)
-        noise = noise.chunk(4)[0].repeat(4, 1, 1, 1)
+        noise = select_and_repeat_instances(slice(0, BLOCK_SIZE), 4, noise, as_view=True)[0]
 
         # Initially, x_starts only contains the original x_start.
         x_starts    = [ x_start ]
@@ -1757,7 +1829,8 @@ class LatentDiffusion(DDPM):
 
             # Sample an earlier timestep for the next denoising step.
             if i < num_denoising_steps - 1:
-                noise = torch.randn_like(x_start.chunk(4)[0]).repeat(4, 1, 1, 1)
+                noise = torch.randn_like(x_start[:BLOCK_SIZE])
+                noise = select_and_repeat_instances(slice(0, BLOCK_SIZE), 4, noise, as_view=True)[0]
 
                 t0 = t.chunk(4)[0]
                 # NOTE: rand_like() samples from U(0, 1), not like randn_like().
@@ -1793,19 +1866,12 @@ class LatentDiffusion(DDPM):
 
         # all_subj_indices are used to extract the attention weights
         # of the subject tokens for the attention loss computation.
-        # Then combine all subject indices into all_subj_indices.
-        # self.embedding_manager.subject_string_dict: the key filter list. Only contains 'z' 
-        # when each image contains a single subject.
-        all_subj_indices = join_dict_of_indices_with_key_filter(extra_info['placeholder2indices'],
-                                                                self.embedding_manager.subject_string_dict)
+        # They have been joined from extra_info['placeholder2indices*'] once in forward().
+        all_subj_indices = extra_info['all_subj_indices']
         if self.iter_flags['do_comp_feat_distill']:
             # all_subj_indices_2b is used in calc_attn_norm_loss() in calc_comp_prompt_distill_loss().
-            all_subj_indices_2b = \
-                join_dict_of_indices_with_key_filter(extra_info['placeholder2indices_2b'],
-                                                     self.embedding_manager.subject_string_dict)
-            all_subj_indices_1b = \
-                join_dict_of_indices_with_key_filter(extra_info['placeholder2indices_1b'],
-                                                     self.embedding_manager.subject_string_dict)
+            all_subj_indices_2b = extra_info['all_subj_indices_2b']
+            all_subj_indices_1b = extra_info['all_subj_indices_1b']
 
         noise = torch.randn_like(x_start) 
 
@@ -1846,7 +1912,8 @@ class LatentDiffusion(DDPM):
             # are more aligned, and more effective for distillation.
             x_start_primed = torch.cat([x_start_ss, x_start_sc, x_start_sc, x_start_mc], dim=0)
 
-            uncond_emb  = self.uncond_context[0].repeat(BLOCK_SIZE * 4, 1, 1)
+            # uncond_emb is read-only. expand() avoids allocating a new tensor.
+            uncond_emb  = self.uncond_context[0].expand(BLOCK_SIZE * 4, -1, -1)
 
             # t is randomly drawn from the middle rear 30% segment of the timesteps (noisy but not too noisy).
             t_midrear = torch.randint(int(self.num_timesteps * 0.5), int(self.num_timesteps * 0.8), 
@@ -1864,7 +1931,8 @@ class LatentDiffusion(DDPM):
             num_nograd_steps = 0 #self.comp_iters_count % W
             # Enable shrink_subj_attn 50% of the time during comp distillation iterations.
             # Same shrink_subj_attn for all denoising steps in a comp_distill_multistep_denoise call.
-            shrink_subj_attn = torch.rand(1) < self.p_shrink_subj_attn
+            # Convert to a python bool, so that it's passed to the attn processors as a plain flag.
+            shrink_subj_attn = (torch.rand(1) < self.p_shrink_subj_attn).item()
 
             # img_mask is used in BasicTransformerBlock.attn1 (self-attention of image tokens),
             # to avoid mixing the invalid blank areas around the augmented images with the valid areas.
@@ -1893,34 +1961,36 @@ class LatentDiffusion(DDPM):
 
             # Log x_start, x_start_maskfilled (noisy and scaled version of the first image in the batch),
             # x_start_primed (x_start_maskfilled denoised for a few steps), and the denoised images for diagnosis.
-            # log_image_colors: a list of 0-3, indexing colors = [ None, 'green', 'red', 'purple' ]
-            # All of them are 1, indicating green.
-            x_start_ss = x_start[:1]
-            input_image = self.decode_first_stage(x_start_ss)
-            # log_image_colors: a list of 0-3, indexing colors = [ None, 'green', 'red', 'purple' ]
-            # All of them are 1, indicating green.
-            log_image_colors = torch.ones(input_image.shape[0], dtype=int, device=x_start.device)
-            self.cache_and_log_generations(input_image, log_image_colors, do_normalize=True)
-
-            x_start_maskfilled = x_start_maskfilled[[0]]
-            log_image_colors = torch.ones(x_start_maskfilled.shape[0], dtype=int, device=x_start.device)
-            x_start_maskfilled_decoded = self.decode_first_stage(x_start_maskfilled)
-            self.cache_and_log_generations(x_start_maskfilled_decoded, log_image_colors, do_normalize=True)
-
-            # NOTE: x_start_primed is primed with 0.3 subj embeddings and 0.7 cls embeddings. Therefore,
-            # the faces still don't look like the subject. What matters is that the background is compositional.
-            x_start_primed = x_start_primed.chunk(2)[0]
-            log_image_colors = torch.ones(x_start_primed.shape[0], dtype=int, device=x_start.device)
-            x_start_primed_decoded = self.decode_first_stage(x_start_primed)
-            self.cache_and_log_generations(x_start_primed_decoded, log_image_colors, do_normalize=True)
-            
-            for i, x_recon in enumerate(x_recons):
-                recon_images = self.decode_first_stage(x_recon)
+            # The VAE decoding is skipped if the generations won't be logged in this iteration.
+            if self.should_log_generations():
+                # log_image_colors: a list of 0-3, indexing colors = [ None, 'green', 'red', 'purple' ]
+                # All of them are 1, indicating green.
+                x_start_ss = x_start[:1]
+                input_image = self.decode_first_stage(x_start_ss)
                 # log_image_colors: a list of 0-3, indexing colors = [ None, 'green', 'red', 'purple' ]
-                # If there are multiple denoising steps, the output images are assigned different colors.
-                log_image_colors = torch.ones(recon_images.shape[0], dtype=int, device=x_start.device) * (i % 4)
+                # All of them are 1, indicating green.
+                log_image_colors = torch.ones(input_image.shape[0], dtype=int, device=x_start.device)
+                self.cache_and_log_generations(input_image, log_image_colors, do_normalize=True)
+
+                x_start_maskfilled = x_start_maskfilled[[0]]
+                log_image_colors = torch.ones(x_start_maskfilled.shape[0], dtype=int, device=x_start.device)
+                x_start_maskfilled_decoded = self.decode_first_stage(x_start_maskfilled)
+                self.cache_and_log_generations(x_start_maskfilled_decoded, log_image_colors, do_normalize=True)
+
+                # NOTE: x_start_primed is primed with 0.3 subj embeddings and 0.7 cls embeddings. Therefore,
+                # the faces still don't look like the subject. What matters is that the background is compositional.
+                x_start_primed = x_start_primed.chunk(2)[0]
+                log_image_colors = torch.ones(x_start_primed.shape[0], dtype=int, device=x_start.device)
+                x_start_primed_decoded = self.decode_first_stage(x_start_primed)
+                self.cache_and_log_generations(x_start_primed_decoded, log_image_colors, do_normalize=True)
+            
+                for i, x_recon in enumerate(x_recons):
+                    recon_images = self.decode_first_stage(x_recon)
+                    # log_image_colors: a list of 0-3, indexing colors = [ None, 'green', 'red', 'purple' ]
+                    # If there are multiple denoising steps, the output images are assigned different colors.
+                    log_image_colors = torch.ones(recon_images.shape[0], dtype=int, device=x_start.device) * (i % 4)
 
-                self.cache_and_log_generations(recon_images, log_image_colors, do_normalize=True)
+                    self.cache_and_log_generations(recon_images, log_image_colors, do_normalize=True)
 
         ###### Begin of loss computation. ######
         loss_dict = {}
@@ -1949,9 +2019,15 @@ class LatentDiffusion(DDPM):
             W = self.recon_num_denoising_steps_range[1] - self.recon_num_denoising_steps_range[0] + 1
             num_recon_denoising_steps = self.normal_recon_iters_count % W + self.recon_num_denoising_steps_range[0]
 
+            # image_unnorm: 0~255 uint8 tensor [BS, 512, 512, 3] -> [BS, 3, 512, 512], -1 ~ 1.
+            # image_unnorm goes through the same instance selection/repetition as x_start in shared_step(),
+            # so gt_pixels are the input images of x_start, and don't need to be decoded from x_start.
+            gt_pixels = self.iter_flags['image_unnorm'].permute(0, 3, 1, 2).to(x_start.device, non_blocking=True)
+            gt_pixels = gt_pixels.float() / 127.5 - 1.0
             loss_normal_recon = \
                 self.calc_normal_recon_loss(num_recon_denoising_steps, x_start, noise, cond_context, img_mask, fg_mask, 
-                                            all_subj_indices, self.recon_bg_pixel_weights, loss_dict, session_prefix)
+                                            all_subj_indices, self.recon_bg_pixel_weights, loss_dict, session_prefix,
+                                            gt_pixels=gt_pixels)
             loss += loss_normal_recon
         ##### end of do_normal_recon #####
 
@@ -1991,11 +2067,14 @@ class LatentDiffusion(DDPM):
         return loss, loss_dict
 
     # If no faces are detected in x_recon, loss_arcface_align is 0, and face_coords is None.
-    def calc_arcface_align_loss(self, x_start, x_recon, bleed=2):
+    # x_start_pixels: the decoded x_start, if the caller has already decoded it. 
+    # Passing it avoids decoding the same x_start once per denoising step.
+    def calc_arcface_align_loss(self, x_start, x_recon, bleed=2, x_start_pixels=None):
         # If there are faceless input images, then do_comp_feat_distill is always False.
         # Thus, here do_comp_feat_distill is always True, and x_start[0] is a valid face image.
         grad_smoother = gen_smooth_grad_layer(kernel_size=1)
-        x_start_pixels = self.decode_first_stage(x_start)
+        if x_start_pixels is None:
+            x_start_pixels = self.decode_first_stage(x_start)
         # subj-comp instance. 
         x_recon_gm = grad_smoother(x_recon)
         # NOTE: use the with_grad version of decode_first_stage. Otherwise no effect.
@@ -2051,16 +2130,17 @@ class LatentDiffusion(DDPM):
         # Set areas outside the face_coords of adv_grad to negative.
         # NOTE: seems this trick still couldn't prevent the bg from being corrupted. Therefore,
         # we should avoid do_adv_attack.
-        face_mask = torch.zeros_like(adv_grad)
-        for i in range(x_start.shape[0]):
-            x1, y1, x2, y2 = face_coords[i]
-            face_mask[i, :, y1:y2, x1:x2] = 1
+        # face_mask: [BS, 1, 64, 64], broadcasted to the 4 channels of adv_grad.
+        face_mask = bboxes_to_mask(face_coords, *adv_grad.shape[-2:], dtype=adv_grad.dtype)
         adv_grad = adv_grad * face_mask
 
         return adv_grad
 
+    # gt_pixels: the input images of x_start in the pixel space (-1 ~ 1). If provided, 
+    # x_start is never decoded by the VAE.
     def calc_normal_recon_loss(self, num_denoising_steps, x_start, noise, cond_context, img_mask, fg_mask, 
-                               all_subj_indices, recon_bg_pixel_weights, loss_dict, session_prefix):
+                               all_subj_indices, recon_bg_pixel_weights, loss_dict, session_prefix,
+                               gt_pixels=None):
         loss_normal_recon = torch.tensor(0.0, device=x_start.device)
         BLOCK_SIZE = x_start.shape[0]
         # t are sampled from the 1/3 ~ 2/3 of the timesteps.
@@ -2077,7 +2157,7 @@ class LatentDiffusion(DDPM):
         if num_denoising_steps > 1 or self.iter_flags['recon_on_comp_prompt']:
             # When doing multi-step denoising, or recon_on_comp_prompt, we apply CFG on the recon images.
             # Use the null prompt as the negative prompt.
-            uncond_emb = self.uncond_context[0].repeat(BLOCK_SIZE, 1, 1)
+            uncond_emb = self.uncond_context[0].expand(BLOCK_SIZE, -1, -1)
             # If cfg_scale == 2, result = 2 * noise_pred - noise_pred_neg.
             cfg_scale  = 2
             # print(f"Rank {self.trainer.global_rank} recon_on_comp_prompt cfg_scale: {cfg_scale:.2f}")
@@ -2099,12 +2179,6 @@ class LatentDiffusion(DDPM):
         do_adv_attack = (self.recon_with_adv_attack_iter_gap > 0) \
                         and (self.normal_recon_iters_count % self.recon_with_adv_attack_iter_gap == 0)
 
-        input_images = self.decode_first_stage(x_start)
-        # log_image_colors: a list of 3, indexing colors = [ None, 'green', 'red', 'purple', 'orange', 'blue' ]
-        # All of them are 3, indicating purple.
-        log_image_colors = torch.ones(input_images.shape[0], dtype=int, device=x_start.device) * 3
-        self.cache_and_log_generations(input_images, log_image_colors, do_normalize=True)
-
         # img_mask is used in BasicTransformerBlock.attn1 (self-attention of image tokens),
         # to avoid mixing the invalid blank areas around the augmented images with the valid areas.
         # (img_mask is not used in the prompt-guided cross-attention layers).
@@ -2117,6 +2191,9 @@ class LatentDiffusion(DDPM):
         losses_recon_subj_mb_suppress = []
         losses_arcface_align_recon = []
         losses_pred_l2 = []
+        # If gt_pixels is not provided, x_start_pixels is decoded lazily at most once, and shared by 
+        # arcface_align_loss of all the denoising steps and the logging of the generations below.
+        x_start_pixels = gt_pixels
 
         for i in range(num_denoising_steps):
             noise, noise_pred, x_recon, ca_layers_activations = \
@@ -2144,17 +2221,31 @@ class LatentDiffusion(DDPM):
             if i >= 1 and self.arcface_align_loss_weight > 0 and (self.arcface is not None):
                 # We can only afford doing arcface_align_loss on two instances. Otherwise, OOM.
                 # If no faces are detected in x_recon, loss_arcface_align is 0, and face_coords is None.
+                # If gt_pixels is not provided, decode the whole x_start, so that it can be reused for logging.
+                if x_start_pixels is None:
+                    x_start_pixels = self.decode_first_stage(x_start)
                 loss_arcface_align_recon, face_coords = \
-                    self.calc_arcface_align_loss(x_start[:FACELOSS_BS], x_recon[:FACELOSS_BS])
+                    self.calc_arcface_align_loss(x_start[:FACELOSS_BS], x_recon[:FACELOSS_BS],
+                                                 x_start_pixels=x_start_pixels[:FACELOSS_BS])
                 
                 losses_arcface_align_recon.append(loss_arcface_align_recon)
             else:
                 losses_arcface_align_recon.append(torch.tensor(0.0, device=x_start.device))
 
-            recon_images = self.decode_first_stage(x_recon)
-            # log_image_colors: a list of 4 or 5, indexing colors = [ None, 'green', 'red', 'purple', 'orange', 'blue' ]
+        # Decode the input images and the x_recons of all steps with a single VAE call.
+        # The decoded images are only used for logging.
+        if self.should_log_generations():
+            if x_start_pixels is None:
+                recon_images = self.decode_first_stage(torch.cat([x_start] + [ x_recon.detach() for x_recon in x_recons ], dim=0))
+            else:
+                # x_start_pixels are gt_pixels, or have been decoded for arcface_align_loss. Only decode the x_recons.
+                recon_images = self.decode_first_stage(torch.cat([ x_recon.detach() for x_recon in x_recons ], dim=0))
+                recon_images = torch.cat([x_start_pixels, recon_images], dim=0)
+            # log_image_colors: indexing colors = [ None, 'green', 'red', 'purple', 'orange', 'blue' ]
+            # 3: purple for the input images. 
             # 4 or 5: orange for the first denoising step, blue for the second denoising step.
-            log_image_colors = torch.ones(recon_images.shape[0], dtype=int, device=x_start.device) * 3 + i + 1
+            log_image_colors = torch.cat([ torch.ones(x_start.shape[0], dtype=int, device=x_start.device) * (3 + i) \
+                                            for i in range(num_denoising_steps + 1) ], dim=0)
             self.cache_and_log_generations(recon_images, log_image_colors, do_normalize=True)
 
         loss_recon_subj_mb_suppress = torch.stack(losses_recon_subj_mb_suppress).mean()
@@ -2163,51 +2254,64 @@ class LatentDiffusion(DDPM):
 
         losses_recon = torch.stack(losses_recon)
         loss_recon   = losses_recon[0]
-        v_loss_recon = loss_recon.mean().detach().item()
-
-        # If fg_mask is None, then loss_recon_subj_mb_suppress = loss_bg_mf_suppress = 0.
-        if loss_recon_subj_mb_suppress > 0:
-            loss_dict.update({f'{session_prefix}/recon_subj_mb_suppress': loss_recon_subj_mb_suppress.mean().detach().item()})
-        if self.iter_flags['recon_on_comp_prompt']:
-            loss_dict.update({f'{session_prefix}/loss_recon_comp': v_loss_recon})
-        else:
-            loss_dict.update({f'{session_prefix}/loss_recon': v_loss_recon})
 
         if num_denoising_steps > 1:
             loss_recon2   = losses_recon[1:].mean()
-            v_loss_recon2 = loss_recon2.mean().detach().item()
-            if self.iter_flags['recon_on_comp_prompt']:
-                loss_dict.update({f'{session_prefix}/loss_recon_comp2': v_loss_recon2})
-            else:
-                loss_dict.update({f'{session_prefix}/loss_recon2': v_loss_recon2})
         else:
-            loss_recon2 = 0
+            loss_recon2   = torch.zeros_like(loss_recon)
 
         extra_recon_steps_discount = 0.5
         # As the recon loss of the extra steps become larger and slightly less accurate, we discount them by 0.5.
-        loss_recon = (loss_recon + loss_recon2 * extra_recon_steps_discount) / (1 + extra_recon_steps_discount)
+        loss_recon_total = (loss_recon + loss_recon2 * extra_recon_steps_discount) / (1 + extra_recon_steps_discount)
         # loss_recon: ~0.1
-        loss_normal_recon += loss_recon
+        loss_normal_recon += loss_recon_total
 
         # loss_recon_subj_mb_suppress: 0.2, recon_subj_mb_suppress_loss_weights: 0.2 -> 0.04, 
         # recon loss: 0.12, loss_recon_subj_mb_suppress is 1/3 of recon loss.
         recon_subj_mb_suppress_loss_weight = self.recon_subj_mb_suppress_loss_weights[self.iter_flags['recon_on_comp_prompt']]
         loss_normal_recon += loss_recon_subj_mb_suppress * recon_subj_mb_suppress_loss_weight
+        # normal_recon_total doesn't include the arcface_align_recon loss.
+        loss_normal_recon_no_arcface = loss_normal_recon.detach().clone()
+
+        # loss_arcface_align_recon: 0.5-0.8. arcface_align_loss_weight: 0.01 => 0.005-0.008.
+        # This loss is around 1/5 of recon/distill losses (0.03).
+        # If arcface is disabled, or no faces are detected, loss_arcface_align_recon is 0. 
+        # So it's always added to loss_normal_recon, without comparing it to 0 on the host side, 
+        # which would sync with the GPU.
+        loss_normal_recon += loss_arcface_align_recon * self.arcface_align_loss_weight
+
+        # Transfer all the logged losses to the host in one go,
+        # instead of syncing with the GPU on each .item().
+        v_loss_recon, v_loss_recon2, v_loss_recon_subj_mb_suppress, v_loss_pred_l2, \
+        v_loss_normal_recon, v_loss_arcface_align_recon = \
+            torch.stack([ loss_recon, loss_recon2, loss_recon_subj_mb_suppress, loss_pred_l2,
+                          loss_normal_recon_no_arcface, loss_arcface_align_recon ]).detach().float().tolist()
+        ts_list = torch.stack(ts).tolist()
+
+        # If fg_mask is None, then loss_recon_subj_mb_suppress = loss_bg_mf_suppress = 0.
+        if v_loss_recon_subj_mb_suppress > 0:
+            loss_dict.update({f'{session_prefix}/recon_subj_mb_suppress': v_loss_recon_subj_mb_suppress})
+        if self.iter_flags['recon_on_comp_prompt']:
+            loss_dict.update({f'{session_prefix}/loss_recon_comp': v_loss_recon})
+        else:
+            loss_dict.update({f'{session_prefix}/loss_recon': v_loss_recon})
+
+        if num_denoising_steps > 1:
+            if self.iter_flags['recon_on_comp_prompt']:
+                loss_dict.update({f'{session_prefix}/loss_recon_comp2': v_loss_recon2})
+            else:
+                loss_dict.update({f'{session_prefix}/loss_recon2': v_loss_recon2})
 
         # loss_pred_l2: 0.92~0.99. But we don't optimize it; instead, it's just for monitoring.
-        loss_dict.update({f'{session_prefix}/pred_l2': loss_pred_l2.mean().detach().item()})
-        ts_str = ", ".join([ f"{t.tolist()}" for t in ts ])
+        loss_dict.update({f'{session_prefix}/pred_l2': v_loss_pred_l2})
+        ts_str = ", ".join([ f"{t}" for t in ts_list ])
         print(f"Rank {self.trainer.global_rank} {num_denoising_steps}-step recon: {ts_str}, {v_loss_recon:.4f}")
 
-        v_loss_normal_recon = loss_normal_recon.mean().detach().item()
         loss_dict.update({f'{session_prefix}/normal_recon_total': v_loss_normal_recon})
 
-        if loss_arcface_align_recon > 0:
-            loss_dict.update({f'{session_prefix}/arcface_align_recon': loss_arcface_align_recon.mean().detach().item() })
-            print(f"Rank {self.trainer.global_rank} arcface_align_recon: {loss_arcface_align_recon.mean().item():.4f}")
-            # loss_arcface_align_recon: 0.5-0.8. arcface_align_loss_weight: 0.01 => 0.005-0.008.
-            # This loss is around 1/5 of recon/distill losses (0.03).
-            loss_normal_recon += loss_arcface_align_recon * self.arcface_align_loss_weight
+        if v_loss_arcface_align_recon > 0:
+            loss_dict.update({f'{session_prefix}/arcface_align_recon': v_loss_arcface_align_recon })
+            print(f"Rank {self.trainer.global_rank} arcface_align_recon: {v_loss_arcface_align_recon:.4f}")
 
         return loss_normal_recon
 
@@ -2242,12 +2346,12 @@ class LatentDiffusion(DDPM):
                 all_id2img_prompt_embs      = self.iter_flags['id2img_prompt_embs'].split(encoders_num_id_vecs, dim=1)
                 all_id2img_neg_prompt_embs  = self.iter_flags['id2img_neg_prompt_embs'].split(encoders_num_id_vecs, dim=1)
                 # If id2ada_prompt_encoder.name == 'jointIDs', the img_prompt_embs are ordered as such.
-                encoder_name2idx = { 'consistentID': 0, 'arc2face': 1 }
+                encoder_name2idx = self.joint_encoder_name2idx
             else:
                 # Single FaceID2AdaPrompt encoder. No need to split id2img_prompt_embs/id2img_neg_prompt_embs.
                 all_id2img_prompt_embs      = [ self.iter_flags['id2img_prompt_embs'] ]
                 all_id2img_neg_prompt_embs  = [ self.iter_flags['id2img_neg_prompt_embs'] ]
-                encoder_name2idx = { self.unet_teacher_types[0]: 0 }
+                encoder_name2idx = self.single_encoder_name2idx
                 
             for unet_teacher_type in self.unet_teacher_types:
                 if unet_teacher_type not in ['consistentID', 'arc2face']:
@@ -2257,7 +2361,8 @@ class LatentDiffusion(DDPM):
                 if unet_teacher_type == 'arc2face':
                     # img_prompt_prefix_embs: the embeddings of a template prompt "photo of a"
                     # For arc2face, p_unet_teacher_uses_cfg is always 0. So we only pass pos_prompt_embs.
-                    img_prompt_prefix_embs = self.img_prompt_prefix_embs.repeat(BLOCK_SIZE, 1, 1)
+                    # expand() instead of repeat(): torch.cat() below copies the data anyway.
+                    img_prompt_prefix_embs = self.img_prompt_prefix_embs.expand(BLOCK_SIZE, -1, -1)
                     # teacher_context: [BS, 4+16, 768] = [BS, 20, 768]
                     teacher_context = torch.cat([img_prompt_prefix_embs, all_id2img_prompt_embs[teacher_idx]], dim=1)
 
@@ -2270,7 +2375,7 @@ class LatentDiffusion(DDPM):
                         # NOTE: Since arc2face doesn't respond to compositional prompts, 
                         # even if unet_distill_uses_comp_prompt,
                         # we don't need to set teacher_neg_context as the negative compositional prompts.
-                        teacher_neg_context = self.uncond_context[0][:, :LEN_POS_PROMPT].repeat(BLOCK_SIZE, 1, 1)
+                        teacher_neg_context = self.uncond_context[0][:, :LEN_POS_PROMPT].expand(BLOCK_SIZE, -1, -1)
                         # The concatenation of teacher_context and teacher_neg_context is done on dim 0.
                         teacher_context = torch.cat([teacher_context, teacher_neg_context], dim=0)
 
@@ -2293,7 +2398,7 @@ class LatentDiffusion(DDPM):
                         global_neg_id_embs = all_id2img_neg_prompt_embs[teacher_idx]
                         # uncond_context is a tuple of (uncond_emb, uncond_prompt_in, extra_info).
                         # uncond_context[0]: [1, 77, 768] -> [BS, 77, 768]
-                        cls_neg_prompt_embs = self.uncond_context[0].repeat(teacher_context.shape[0], 1, 1)
+                        cls_neg_prompt_embs = self.uncond_context[0].expand(teacher_context.shape[0], -1, -1)
 
                         # teacher_neg_context: [BS, 81, 768]
                         teacher_neg_context = torch.cat([cls_neg_prompt_embs, global_neg_id_embs], dim=1)
@@ -2304,10 +2409,11 @@ class LatentDiffusion(DDPM):
 
                 teacher_contexts.append(teacher_context)
             # If there's only one teacher, then self.unet_teacher is not a UNetEnsembleTeacher.
-            # So we dereference the list.
-            if len(teacher_contexts) == 1:
-                teacher_contexts = teacher_contexts[0]
+            # It takes the only context out of the list by itself.
 
+        # NOTE: we don't use torch.inference_mode() here. unet_teacher_noise_preds are used as the
+        # targets of mse_loss(), which saves them for backward. Inference tensors cannot be saved 
+        # for backward, and to() doesn't copy them when the dtype is unchanged.
         with torch.no_grad():
             unet_teacher_noise_preds, unet_teacher_x_starts, unet_teacher_noises, all_t = \
                 self.unet_teacher(self, x_start, noise, t, teacher_contexts, 
@@ -2322,9 +2428,10 @@ class LatentDiffusion(DDPM):
 
         # The outputs of the remaining denoising steps will be appended to noise_preds.
         noise_preds = []
-        #all_recon_images = []
+        # x_recons are only used for logging. They are decoded in one batch after the loop.
+        x_recons    = []
 
-        uncond_emb = self.uncond_context[0].repeat(BLOCK_SIZE, 1, 1)
+        uncond_emb = self.uncond_context[0].expand(BLOCK_SIZE, -1, -1)
 
         for s in range(num_unet_denoising_steps):
             # Predict the noise with t_s (a set of earlier t).
@@ -2358,12 +2465,16 @@ class LatentDiffusion(DDPM):
                                     use_ffn_lora=self.unet_uses_ffn_lora)   
 
             noise_preds.append(noise_pred_s)
+            x_recons.append(x_recon_s.detach())
 
-            recon_images_s = self.decode_first_stage(x_recon_s)
+        # Decode the x_recons of all steps with a single VAE call, instead of one call per step.
+        # The order of the decoded images is the same as decoding them step by step.
+        if self.should_log_generations():
+            recon_images = self.decode_first_stage(torch.cat(x_recons, dim=0))
             # log_image_colors: a list of 0-3, indexing colors = [ None, 'green', 'red', 'purple' ]
             # all of them are 2, indicating red.
-            log_image_colors = torch.ones(recon_images_s.shape[0], dtype=int, device=x_start.device) * 2
-            self.cache_and_log_generations(recon_images_s, log_image_colors, do_normalize=True)
+            log_image_colors = torch.ones(recon_images.shape[0], dtype=int, device=x_start.device) * 2
+            self.cache_and_log_generations(recon_images, log_image_colors, do_normalize=True)
 
         print(f"Rank {self.trainer.global_rank} {len(noise_preds)}-step distillation:")
         losses_unet_distill = []
@@ -2390,8 +2501,6 @@ class LatentDiffusion(DDPM):
                                 img_mask, fg_mask, fg_pixel_weight=1,
                                 bg_pixel_weight=recon_bg_pixel_weight)
 
-            print(f"Rank {self.trainer.global_rank} Step {s}: {all_t[s].tolist()}, {loss_unet_distill.item():.4f}")
-            
             losses_unet_distill.append(loss_unet_distill)
 
             # Try hard to release memory after each step. But since they are part of the computation graph,
@@ -2401,9 +2510,19 @@ class LatentDiffusion(DDPM):
         # If num_unet_denoising_steps > 1, most loss_unet_distill are usually 0.001~0.005, but sometimes there are a few large loss_unet_distill.
         # In order not to dilute the large loss_unet_distill, we don't divide by num_unet_denoising_steps.
         # Instead, only increase the normalizer sub-linearly.
-        loss_unet_distill = sum(losses_unet_distill) / np.sqrt(num_unet_denoising_steps)
+        # Reduce the per-step losses with a single kernel, instead of a chain of python additions.
+        losses_unet_distill = torch.stack(losses_unet_distill)
+        loss_unet_distill   = losses_unet_distill.sum() / np.sqrt(num_unet_denoising_steps)
+
+        # Transfer the per-step losses and the total loss to the host in one go,
+        # instead of syncing with the GPU on each .item() in the loop.
+        NS = len(losses_unet_distill)
+        log_values  = torch.cat([ losses_unet_distill, loss_unet_distill.reshape(1) ]).detach().float().tolist()
+        v_losses_unet_distill, v_loss_unet_distill = log_values[:NS], log_values[NS]
+        all_t_list = torch.stack(all_t[:NS]).tolist()
+        for s in range(NS):
+            print(f"Rank {self.trainer.global_rank} Step {s}: {all_t_list[s]}, {v_losses_unet_distill[s]:.4f}")
 
-        v_loss_unet_distill = loss_unet_distill.mean().detach().item()
         loss_dict.update({f'{session_prefix}/loss_unet_distill': v_loss_unet_distill})
 
         return loss_unet_distill
@@ -2422,13 +2541,17 @@ class LatentDiffusion(DDPM):
         # We use random noise for x_start, and 80% of the time, we use the training images.
         # NOTE: DO NOT x_start.normal_() here, as it will overwrite the x_start in the caller,
         # which is useful for loss computation.
-        x_start = torch.randn_like(x_start) 
+        # Only the first BLOCK_SIZE instances are kept, so only sample BLOCK_SIZE instances.
+        x_start = torch.randn_like(x_start[:BLOCK_SIZE]) 
         # Set fg_mask to be the whole image.
-        fg_mask = torch.ones_like(fg_mask)
+        # Only the first BLOCK_SIZE instances are kept below, so only allocate BLOCK_SIZE instances.
+        fg_mask = torch.ones_like(fg_mask[:BLOCK_SIZE])
 
         # Make the 4 instances in x_start, noise and t the same.
-        x_start = x_start[:BLOCK_SIZE].repeat(4, 1, 1, 1)
-        noise   = noise[:BLOCK_SIZE].repeat(4, 1, 1, 1)
+        x_start = x_start.repeat(4, 1, 1, 1)
+        # noise is only read in the priming denoising. So if BLOCK_SIZE == 1, 
+        # it's an expanded view of the first instance, instead of 4 copies.
+        noise   = select_and_repeat_instances(slice(0, BLOCK_SIZE), 4, noise, as_view=True)[0]
         # In priming denoising steps, t is randomly drawn from the terminal 25% segment of the timesteps (very noisy).
         t_rear = torch.randint(int(self.num_timesteps * 0.75), int(self.num_timesteps * 1), 
                                 (BLOCK_SIZE,), device=x_start.device)
@@ -2439,7 +2562,9 @@ class LatentDiffusion(DDPM):
         
         # masks may have been changed in init_x_with_fg_from_training_image(). So we update it.
         # Update masks to be a 1-repeat-4 structure.
-        masks = select_and_repeat_instances(slice(0, BLOCK_SIZE), 4, img_mask, fg_mask)
+        # The masks are only read (interpolated, multiplied) afterwards, so if BLOCK_SIZE == 1,
+        # they are expanded views of the single mask, instead of 4 copies.
+        masks = select_and_repeat_instances(slice(0, BLOCK_SIZE), 4, img_mask, fg_mask, as_view=True)
 
         # If num_primed_denoising_steps > 1, then we split the denoising steps into
         # shared denoising steps and separate denoising steps.
@@ -2450,7 +2575,8 @@ class LatentDiffusion(DDPM):
         # The number of separate denoising steps is around 2/3 of num_primed_denoising_steps, and at least 1.
         num_sep_denoising_steps     = max(num_primed_denoising_steps - MAX_N_SHARED, 1)
         num_shared_denoising_steps  = num_primed_denoising_steps - num_sep_denoising_steps
-        all_t_list = []
+        # The first t of each priming step. They are transferred to the host in one go for printing.
+        all_t0s = []
 
         uncond_emb = self.uncond_context[0]
 
@@ -2471,7 +2597,9 @@ class LatentDiffusion(DDPM):
             # we need to pass the negative prompt as well.
             # cfg_scale_range of comp_distill_priming_unet is [2, 4].
             # primed_noises: the noises that have been used in the denoising.
-            with torch.no_grad():
+            # The outputs are only consumed through repeat(), which creates normal tensors 
+            # outside of inference mode. So inference_mode() is safe here.
+            with torch.inference_mode():
                 primed_noise_preds, primed_x_starts, primed_noises, all_t = \
                     self.comp_distill_priming_unet(self, x_start_1, noise_1, t_1, 
                                                    # In each timestep, the unet ensemble will do denoising on the same x_start_1 
@@ -2498,10 +2626,12 @@ class LatentDiffusion(DDPM):
                 t_lb = t_1 * np.power(0.65, np.power(num_sep_denoising_steps + 1, -0.3))
                 t_ub = t_1 * np.power(0.8,  np.power(num_sep_denoising_steps + 1, -0.3))
                 t_lb = torch.clamp(t_lb, min=400)
-                t_2  = (t_ub - t_lb) * torch.rand(1, device=t_1.device) + t_lb
+                # t_2 = (t_ub - t_lb) * rand + t_lb, computed on the device in one lerp kernel.
+                # Sampling on the host would instead need a GPU sync to read t_lb and t_ub.
+                t_2  = torch.lerp(t_lb, t_ub, torch.rand(1, device=t_1.device))
                 t_2  = t_2.long().repeat(2)
 
-            all_t_list  += [ ti[0].item() for ti in all_t ]
+            all_t0s     += [ ti[0] for ti in all_t ]
         else:
             # Class priming denoising: Denoise x_start_2 with the class single/comp prompts 
             # for num_sep_denoising_steps times, using self.comp_distill_priming_unet.
@@ -2515,7 +2645,10 @@ class LatentDiffusion(DDPM):
         # Here we ensure the two instances (one single, one comp) use the same noise,
         # since the third block is the subj-comp-rep instance, using different noise 
         # will lead to multiple-face artifacts.
-        noise_2 = torch.randn_like(x_start[:BLOCK_SIZE]).repeat(2, 1, 1, 1)
+        # noise_2 is only read by the priming unet (which takes its first instance), 
+        # so it's an expanded view if BLOCK_SIZE == 1.
+        noise_2 = select_and_repeat_instances(slice(0, BLOCK_SIZE), 2, torch.randn_like(x_start[:BLOCK_SIZE]), 
+                                              as_view=True)[0]
         subj_double_prompt_emb, cls_double_prompt_emb = prompt_emb.chunk(2)
         # ** Do num_sep_denoising_steps of separate denoising steps with the single-comp prompts.
         # x_start_2[0] is denoised with the single prompt (both subj single and cls single before averaging), 
@@ -2528,7 +2661,8 @@ class LatentDiffusion(DDPM):
         else:
             teacher_context=[ torch.cat([subj_single_prompt_emb, cls_comp_prompt_emb], dim=0) ]
 
-        with torch.no_grad():
+        # Same as above, primed_x_starts[-1] is only consumed through repeat(). 
+        with torch.inference_mode():
             primed_noise_preds, primed_x_starts, primed_noises, all_t = \
                 self.comp_distill_priming_unet(self, x_start_2, noise_2, t_2, 
                                                # In each timestep, the unet ensemble will do denoising on the same x_start_2 
@@ -2541,7 +2675,8 @@ class LatentDiffusion(DDPM):
                                                # Same t and noise across instances.
                                                same_t_noise_across_instances=True)
         
-        all_t_list += [ ti[0].item() for ti in all_t ]
+        all_t0s += [ ti[0] for ti in all_t ]
+        all_t_list = torch.stack(all_t0s).tolist()
         print(f"Rank {self.trainer.global_rank} step {self.global_step}: "
                 f"subj-cls ensemble prime denoising {num_primed_denoising_steps} steps {all_t_list}")
         
@@ -2554,7 +2689,9 @@ class LatentDiffusion(DDPM):
         # Regenerate the noise, since the noise has been used above.
         # Ensure the two types of instances (single, comp) use different noise.
         # ** But subj and cls instances use the same noise.
-        noise           = torch.randn_like(x_start[:BLOCK_SIZE]).repeat(4, 1, 1, 1)
+        # noise is only read by q_sample() afterwards, so it's an expanded view if BLOCK_SIZE == 1.
+        noise           = select_and_repeat_instances(slice(0, BLOCK_SIZE), 4, torch.randn_like(x_start[:BLOCK_SIZE]), 
+                                                      as_view=True)[0]
         x_start_primed  = x_start
         # noise and masks are updated to be a 1-repeat-4 structure in prime_x_start_for_comp_prompts().
         # We return noise to make the noise_gt up-to-date, which is the recon objective.
@@ -2569,11 +2706,16 @@ class LatentDiffusion(DDPM):
                                     all_subj_indices_1b, all_subj_indices_2b, 
                                     prompt_emb_mask_4b, prompt_pad_mask_4b,
                                     BLOCK_SIZE, loss_dict, session_prefix):
-        losses_comp_fg_bg_preserve          = []
-        losses_subj_attn_norm_distill       = []
-        losses_comp_rep_distill_subj_attn   = []
-        losses_comp_rep_distill_subj_k      = []
-        losses_comp_rep_distill_nonsubj_k   = []
+        # The losses of the steps are summed into running accumulators, and averaged after the loop.
+        # loss_comp_fg_bg_preserve is only computed on some of the steps, 
+        # so the number of such steps is counted separately.
+        zero_loss = torch.tensor(0., device=x_start.device, dtype=x_start.dtype)
+        sum_comp_fg_bg_preserve             = zero_loss
+        comp_fg_bg_preserve_count           = 0
+        sum_subj_attn_norm_distill          = zero_loss
+        sum_comp_rep_distill_subj_attn      = zero_loss
+        sum_comp_rep_distill_subj_k         = zero_loss
+        sum_comp_rep_distill_nonsubj_k      = zero_loss
 
         ss_fg_mask, sc_fg_mask, ss_face_bboxes, sc_face_bboxes = None, None, None, None
         sc_face_detected_at_step = -1
@@ -2589,25 +2731,32 @@ class LatentDiffusion(DDPM):
             # we use the reconstructed images of the subject-single block in the last step
             # to detect the face area in the subject-single images. 
             ss_x_recon = x_recons[-1].chunk(4)[0]
-            ss_x_recon_pixels = self.decode_first_stage(ss_x_recon)
-            # The cropping operation is wrapped with torch.no_grad() in retinaface implementation.
-            # So we don't need to wrap it here.
-            # bleed=4: remove 4 pixels from each side of the detected face area.
-            faces, failed_indices, ss_face_bboxes = \
-                self.arcface.retinaface.crop_faces(ss_x_recon_pixels, out_size=(128, 128), T=20, bleed=4,
-                                                   use_whole_image_if_no_face=False)
-            if len(failed_indices) == 0:
-                # If there are no failed indices, then we get ss_fg_mask.
+            # Decode and detect the faces one instance at a time, and stop at the first failure.
+            # If any instance has no detectable face, ss_fg_mask is not computed, 
+            # so the remaining instances don't need to be decoded.
+            ss_face_bboxes_list = []
+            for i in range(BLOCK_SIZE):
+                ss_x_recon_pixels = self.decode_first_stage(ss_x_recon[i:i+1])
+                # The cropping operation is wrapped with torch.no_grad() in retinaface implementation.
+                # So we don't need to wrap it here.
+                # bleed=4: remove 4 pixels from each side of the detected face area.
+                faces, failed_indices, ss_face_bboxes_i = \
+                    self.arcface.retinaface.crop_faces(ss_x_recon_pixels, out_size=(128, 128), T=20, bleed=4,
+                                                       use_whole_image_if_no_face=False)
+                if len(failed_indices) > 0:
+                    break
+                ss_face_bboxes_list.append(ss_face_bboxes_i)
+
+            if len(ss_face_bboxes_list) == BLOCK_SIZE:
+                # If faces are detected in all the instances, then we get ss_fg_mask.
                 # NOTE: ss_face_bboxes are coords on ss_x_recon_pixels, 512*512.
                 # ss_fg_mask is on the latents, 64*64. So we scale ss_face_bboxes down by 8.
+                ss_face_bboxes = torch.cat(ss_face_bboxes_list, dim=0)
                 ss_face_bboxes = pixel_bboxes_to_latent(ss_face_bboxes, ss_x_recon_pixels.shape[-1], x_start.shape[-1])
-                ss_fg_mask = torch.zeros(BLOCK_SIZE, 1, x_start.shape[-2], x_start.shape[-1], device=x_start.device)
-                # ss_fg_mask is zero-initialized.
+                # ss_fg_mask: [BLOCK_SIZE, 1, 64, 64], 1 within the face bboxes, and 0 elsewhere.
                 # len(ss_face_bboxes) == BLOCK_SIZE == len(sg_fg_mask), usually 1.
-                for i in range(len(ss_face_bboxes)):
-                    x1, y1, x2, y2 = ss_face_bboxes[i]
-                    ss_fg_mask[i, :, y1:y2, x1:x2] = 1
-                    print(f"Rank {self.trainer.global_rank} SS face coords {i}: {ss_face_bboxes[i]}.", end=' ')
+                ss_fg_mask = bboxes_to_mask(ss_face_bboxes, x_start.shape[-2], x_start.shape[-1])
+                print(f"Rank {self.trainer.global_rank} SS face coords: {ss_face_bboxes.tolist()}.", end=' ')
 
                 # If a face cannot be detected in the subject-single instance, then it probably
                 # won't be detected in the subject-compositional instance either.
@@ -2625,17 +2774,14 @@ class LatentDiffusion(DDPM):
                 # loss_comp_feat_distill: 0.07, 60% of comp distillation loss.
                 loss_comp_feat_distill += loss_comp_sc_subj_mb_suppress * self.comp_sc_subj_mb_suppress_loss_weight
 
-        loss_names = [ 'loss_sc_recon_ssfg_attn_agg', 'loss_sc_recon_ssfg_flow', 'loss_sc_recon_ssfg_min', 
-                       'loss_sc_recon_mc_attn_agg',   'loss_sc_recon_mc_flow',   'loss_sc_recon_mc_sameloc', 'loss_sc_recon_mc_min',
-                       'loss_sc_to_ssfg_sparse_attns_distill', 'loss_sc_to_mc_sparse_attns_distill',
-                       'loss_comp_subj_bg_attn_suppress', 
-                       'ssfg_flow_win_rate', 'mc_flow_win_rate', 'mc_sameloc_win_rate',
-                       'ssfg_avg_sparse_distill_weight', 'mc_avg_sparse_distill_weight' ]
-        
-        for loss_name in loss_names:
-            loss_name2 = loss_name.replace('loss_', '')
-            loss_name2 = f'{session_prefix}/{loss_name2}'
-            loss_dict[loss_name2] = 0
+        # The keys of the losses logged by calc_comp_subj_bg_preserve_loss() are built once per session_prefix.
+        if session_prefix not in self.comp_feat_distill_log_keys:
+            self.comp_feat_distill_log_keys[session_prefix] = \
+                [ f"{session_prefix}/{loss_name.replace('loss_', '')}" for loss_name in COMP_FEAT_DISTILL_LOSS_NAMES ]
+        log_keys = self.comp_feat_distill_log_keys[session_prefix]
+
+        for log_key in log_keys:
+            loss_dict[log_key] = 0
 
         if sc_fg_mask is not None:
             sc_fg_mask_percent = sc_fg_mask.float().mean().item()
@@ -2657,19 +2803,19 @@ class LatentDiffusion(DDPM):
                                     ca_layers_activations['attn'], 
                                     all_subj_indices_2b, BLOCK_SIZE)
 
-            losses_subj_attn_norm_distill.append(loss_subj_attn_norm_distill)
+            sum_subj_attn_norm_distill = sum_subj_attn_norm_distill + loss_subj_attn_norm_distill
         
             loss_comp_rep_distill_subj_attn, loss_comp_rep_distill_subj_k, loss_comp_rep_distill_nonsubj_k = \
                 calc_subj_comp_rep_distill_loss(ca_layers_activations, all_subj_indices_1b, 
                                                 prompt_emb_mask_4b,    prompt_pad_mask_4b,
                                                 sc_fg_mask_percent,    FG_THRES=rep_dist_fg_bounds[0])
+            # zero_loss is only added out-of-place into the accumulators, so it can be shared.
             if loss_comp_rep_distill_subj_attn == 0:
-                loss_comp_rep_distill_subj_attn = loss_comp_rep_distill_subj_k = loss_comp_rep_distill_nonsubj_k = \
-                    torch.tensor(0., device=x_start.device, dtype=x_start.dtype)
+                loss_comp_rep_distill_subj_attn = loss_comp_rep_distill_subj_k = loss_comp_rep_distill_nonsubj_k = zero_loss
 
-            losses_comp_rep_distill_subj_attn.append(loss_comp_rep_distill_subj_attn)
-            losses_comp_rep_distill_subj_k.append(loss_comp_rep_distill_subj_k)
-            losses_comp_rep_distill_nonsubj_k.append(loss_comp_rep_distill_nonsubj_k)
+            sum_comp_rep_distill_subj_attn  = sum_comp_rep_distill_subj_attn  + loss_comp_rep_distill_subj_attn
+            sum_comp_rep_distill_subj_k     = sum_comp_rep_distill_subj_k     + loss_comp_rep_distill_subj_k
+            sum_comp_rep_distill_nonsubj_k  = sum_comp_rep_distill_nonsubj_k  + loss_comp_rep_distill_nonsubj_k
 
             # NOTE: Skip computing loss_comp_fg_bg_preserve before sc_face is detected.
             # If sc_face_detected_at_step == -1, then in all steps, sc_face is not detected.
@@ -2689,68 +2835,74 @@ class LatentDiffusion(DDPM):
                                                 sc_fg_mask, ss_face_bboxes, sc_face_bboxes,
                                                 recon_feat_objectives=['attn_out', 'outfeat'],
                                                 recon_loss_discard_threses={'mc': 0.5, 'ssfg': 0.4})
-            losses_comp_fg_bg_preserve.append(loss_comp_fg_bg_preserve)
+            sum_comp_fg_bg_preserve   = sum_comp_fg_bg_preserve + loss_comp_fg_bg_preserve
+            comp_fg_bg_preserve_count += 1
 
             # ca_layers_activations['outfeat'] is a dict as: layer_idx -> ca_outfeat. 
             # It contains the 3 specified cross-attention layers of UNet. i.e., layers 22, 23, 24.
             # Similar are ca_attns and ca_attns, each ca_outfeats in ca_outfeats is already 4D like [4, 8, 64, 64].
 
-        for loss_name in loss_names:
-            loss_name2 = loss_name.replace('loss_', '')
-            loss_name2 = f'{session_prefix}/{loss_name2}'
-            if loss_name2 in loss_dict:
-                if loss_dict[loss_name2] > 0:
-                    loss_dict[loss_name2] = loss_dict[loss_name2] / len(ca_layers_activations_list)
+        for log_key in log_keys:
+            if log_key in loss_dict:
+                if loss_dict[log_key] > 0:
+                    loss_dict[log_key] = loss_dict[log_key] / len(ca_layers_activations_list)
                 else:
                     # Remove 0 losses from the loss_dict.
-                    del loss_dict[loss_name2]
+                    del loss_dict[log_key]
 
-        loss_comp_rep_distill_subj_attn  = torch.stack(losses_comp_rep_distill_subj_attn).mean()
-        loss_comp_rep_distill_subj_k     = torch.stack(losses_comp_rep_distill_subj_k).mean()
-        loss_comp_rep_distill_nonsubj_k  = torch.stack(losses_comp_rep_distill_nonsubj_k).mean()
-        loss_subj_attn_norm_distill      = torch.stack(losses_subj_attn_norm_distill).mean()
+        num_steps = len(ca_layers_activations_list)
+        loss_comp_rep_distill_subj_attn  = sum_comp_rep_distill_subj_attn  / num_steps
+        loss_comp_rep_distill_subj_k     = sum_comp_rep_distill_subj_k     / num_steps
+        loss_comp_rep_distill_nonsubj_k  = sum_comp_rep_distill_nonsubj_k  / num_steps
+        loss_subj_attn_norm_distill      = sum_subj_attn_norm_distill      / num_steps
 
-        if len(losses_comp_fg_bg_preserve) > 0:
-            loss_comp_fg_bg_preserve = torch.stack(losses_comp_fg_bg_preserve).mean()
-        else:
-            # Set all the losses to 0 if there's no step to calculate the losses.
-            loss_comp_fg_bg_preserve = torch.tensor(0., device=x_start.device, dtype=x_start.dtype)
+        # If there's no step to calculate loss_comp_fg_bg_preserve, it remains 0.
+        loss_comp_fg_bg_preserve = sum_comp_fg_bg_preserve / max(comp_fg_bg_preserve_count, 1)
             
-        if loss_comp_fg_bg_preserve > 0:
-            loss_dict.update({f'{session_prefix}/comp_fg_bg_preserve': loss_comp_fg_bg_preserve.mean().detach().item() })
-            # loss_comp_fg_bg_preserve: 2~3.
-            # loss_sc_recon_ssfg_min and loss_sc_recon_mc_min is absorbed into loss_comp_fg_bg_preserve.
-            loss_comp_feat_distill += loss_comp_fg_bg_preserve
-
-        # loss_subj_attn_norm_distill: 0.01~0.03. Currently disabled.
-        if loss_subj_attn_norm_distill > 0:
-            loss_dict.update({f'{session_prefix}/subj_attn_norm_distill': loss_subj_attn_norm_distill.mean().detach().item() })
-
-        if loss_comp_rep_distill_subj_attn > 0:
-            loss_dict.update({f'{session_prefix}/comp_rep_distill_subj_attn':  loss_comp_rep_distill_subj_attn.item() })
-            loss_dict.update({f'{session_prefix}/comp_rep_distill_subj_k':     loss_comp_rep_distill_subj_k.item() })
-            loss_dict.update({f'{session_prefix}/comp_rep_distill_nonsubj_k':  loss_comp_rep_distill_nonsubj_k.item() })
-            # If sc_fg_mask_percent == 0.22, then fg_percent_rep_distill_scale = 0.1.
-            # If sc_fg_mask_percent >= 0.25, then fg_percent_rep_distill_scale = 2.
-            # valid_scale_range=(0.02, 1): If sc_fg_mask_percent = 0.19, then fg_percent_rep_distill_scale = 0.02.
-            if sc_fg_mask_percent > 0:
-                fg_percent_rep_distill_scale = \
-                    calc_dyn_loss_scale(sc_fg_mask_percent, (rep_dist_fg_bounds[1], 0.1), (rep_dist_fg_bounds[2], 2), 
-                                        valid_scale_range=(0.02, 2))
-            else:
-                # sc_fg_mask_percent == 0 means no face is detected in the subject-comp instance.
-                # In this case, we don't do distillation on the subject-comp-rep instance.
-                fg_percent_rep_distill_scale = 0
-
-            # If do_comp_feat_distill is less frequent, then increase the weight of loss_subj_comp_rep_distill_*.
-            loss_subj_comp_rep_distill_scale = self.comp_distill_iter_gap * fg_percent_rep_distill_scale
+        # loss_comp_fg_bg_preserve: 2~3.
+        # loss_sc_recon_ssfg_min and loss_sc_recon_mc_min is absorbed into loss_comp_fg_bg_preserve.
+        # The losses below are 0 if they are not computed, so they are added unconditionally,
+        # without comparing them to 0 on the host side.
+        loss_comp_feat_distill += loss_comp_fg_bg_preserve
+
+        # If sc_fg_mask_percent == 0.22, then fg_percent_rep_distill_scale = 0.1.
+        # If sc_fg_mask_percent >= 0.25, then fg_percent_rep_distill_scale = 2.
+        # valid_scale_range=(0.02, 1): If sc_fg_mask_percent = 0.19, then fg_percent_rep_distill_scale = 0.02.
+        if sc_fg_mask_percent > 0:
+            fg_percent_rep_distill_scale = \
+                calc_dyn_loss_scale(sc_fg_mask_percent, (rep_dist_fg_bounds[1], 0.1), (rep_dist_fg_bounds[2], 2), 
+                                    valid_scale_range=(0.02, 2))
+        else:
+            # sc_fg_mask_percent == 0 means no face is detected in the subject-comp instance.
+            # In this case, we don't do distillation on the subject-comp-rep instance.
+            fg_percent_rep_distill_scale = 0
+
+        # If do_comp_feat_distill is less frequent, then increase the weight of loss_subj_comp_rep_distill_*.
+        # If loss_comp_rep_distill_subj_attn == 0, then the subj_k and nonsubj_k losses are 0 as well.
+        loss_subj_comp_rep_distill_scale = self.comp_distill_iter_gap * fg_percent_rep_distill_scale
+        loss_comp_feat_distill += (loss_comp_rep_distill_subj_attn + loss_comp_rep_distill_subj_k + \
+                                        loss_comp_rep_distill_nonsubj_k) * loss_subj_comp_rep_distill_scale
+
+        # Transfer all the logged losses to the host in one go, 
+        # instead of syncing with the GPU on each comparison and .item().
+        log_losses = { 'comp_fg_bg_preserve':          loss_comp_fg_bg_preserve,
+                       # loss_subj_attn_norm_distill: 0.01~0.03. Currently disabled.
+                       'subj_attn_norm_distill':       loss_subj_attn_norm_distill,
+                       'comp_rep_distill_subj_attn':   loss_comp_rep_distill_subj_attn,
+                       'comp_rep_distill_subj_k':      loss_comp_rep_distill_subj_k,
+                       'comp_rep_distill_nonsubj_k':   loss_comp_rep_distill_nonsubj_k,
+                       'comp_feat_distill_total':      loss_comp_feat_distill }
+        log_values = torch.stack([ loss.mean().detach().float() for loss in log_losses.values() ]).tolist()
+        log_values = dict(zip(log_losses.keys(), log_values))
+
+        for loss_name in ['comp_fg_bg_preserve', 'subj_attn_norm_distill', 'comp_feat_distill_total']:
+            if log_values[loss_name] > 0:
+                loss_dict.update({f'{session_prefix}/{loss_name}': log_values[loss_name]})
+        # The 3 comp_rep_distill losses are logged together, when loss_comp_rep_distill_subj_attn > 0.
+        if log_values['comp_rep_distill_subj_attn'] > 0:
+            for loss_name in ['comp_rep_distill_subj_attn', 'comp_rep_distill_subj_k', 'comp_rep_distill_nonsubj_k']:
+                loss_dict.update({f'{session_prefix}/{loss_name}': log_values[loss_name]})
 
-            loss_comp_feat_distill += (loss_comp_rep_distill_subj_attn + loss_comp_rep_distill_subj_k + \
-                                            loss_comp_rep_distill_nonsubj_k) * loss_subj_comp_rep_distill_scale
-            
-        v_loss_comp_feat_distill = loss_comp_feat_distill.mean().detach().item()
-        if v_loss_comp_feat_distill > 0:
-            loss_dict.update({f'{session_prefix}/comp_feat_distill_total': v_loss_comp_feat_distill})
         return loss_comp_feat_distill            
 
     def calc_comp_face_align_and_mb_suppress_losses(self, x_start, x_recons, ca_layers_activations_list,
@@ -2768,13 +2920,16 @@ class LatentDiffusion(DDPM):
             # Trying to calc arcface_align_loss from difficult to easy steps.
             # sel_step: 0~2. 0 is the hardest for face detection (denoised once), and 2 is the easiest (denoised 3 times).
 
+            # iter_flags['do_comp_feat_distill'] is True, which guarantees that 
+            # there are no faceless input images. Thus, x_start[0] is always a valid face image.
+            x_start_ss          = x_start.chunk(4)[0]
+            # x_start_ss is the same across the steps. So it's decoded lazily at most once.
+            x_start_ss_pixels   = None
+
             for sel_step in range(len(x_recons)):
                 if sel_step == 0:
                     continue
                 x_recon  = x_recons[sel_step]
-                # iter_flags['do_comp_feat_distill'] is True, which guarantees that 
-                # there are no faceless input images. Thus, x_start[0] is always a valid face image.
-                x_start_ss       = x_start.chunk(4)[0]
                 # Only compute arcface_align_loss on the subj comp block, as 
                 # the subj single block was generated without gradient.
                 subj_comp_recon  = x_recon.chunk(4)[1]
@@ -2784,8 +2939,11 @@ class LatentDiffusion(DDPM):
                 # and sc_face_bboxes is None.
                 # NOTE: In the first iteration, sc_fg_mask is None, and it's fine.
                 
+                if x_start_ss_pixels is None:
+                    x_start_ss_pixels = self.decode_first_stage(x_start_ss)
                 loss_arcface_align_comp_step, sc_face_bboxes = \
-                    self.calc_arcface_align_loss(x_start_ss, subj_comp_recon, bleed=2)
+                    self.calc_arcface_align_loss(x_start_ss, subj_comp_recon, bleed=2,
+                                                 x_start_pixels=x_start_ss_pixels)
                 # Found valid face images. Stop trying, since we cannot afford calculating loss_arcface_align_comp for > 1 steps.
                 if loss_arcface_align_comp_step > 0:
                     print(f"Rank-{self.trainer.global_rank} arcface_align_comp step {sel_step+1}/{len(x_recons)}")
@@ -2797,21 +2955,20 @@ class LatentDiffusion(DDPM):
 
                     # Generate sc_fg_mask for the first time, based on the detected face area.
                     if sc_fg_mask is None:
-                        # sc_fg_mask: [1, 1, 64, 64].
-                        sc_fg_mask = torch.zeros_like(x_start_ss[:, :1])
                         # When loss_arcface_align_comp > 0, sc_face_bboxes is always not None.
                         # sc_face_bboxes: [[22, 15, 36, 33]], already scaled down to 64*64.
+                        # Add PAD pixels to each side of the detected face area 
+                        # (clipped by the image borders), to protect it from being suppressed.
+                        # sc_fg_mask: [1, 1, 64, 64].
                         PAD = 1
-                        for i in range(len(sc_face_bboxes)):
-                            x1, y1, x2, y2 = sc_face_bboxes[i]
-                            H, W = x_start_ss.shape[-2:]
-                            x1, y1, x2, y2 = max(x1-PAD, 0), max(y1-PAD, 0), min(x2+PAD, W), min(y2+PAD, H)
-                            # Add 4 pixels (2*bleed that undoes the bleed and adds 2 extra pixels) to each side of 
-                            # the detected face area, to protect it from being suppressed.
-                            sc_fg_mask[i, :, y1:y2, x1:x2] = 1
+                        H, W = x_start_ss.shape[-2:]
+                        sc_fg_mask = bboxes_to_mask(sc_face_bboxes, H, W, pad=PAD, dtype=x_start_ss.dtype)
                     # ca_layers_activations['attn']: { 22 -> [4, 8, 4096, 77], 23 -> [4, 8, 4096, 77], 24 -> [4, 8, 4096, 77] }.
                     # sc_attn_dict: { 22 -> [1, 8, 64, 64], 23 -> [1, 8, 64, 64], 24 -> [1, 8, 64, 64] }.
-                    sc_attn_dict = { layer_idx: attn.chunk(4)[1] for layer_idx, attn in ca_layers_activations['attn'].items() }
+                    # narrow() returns the subject-comp block as a single view, instead of creating 
+                    # views of all the 4 blocks with chunk(4) and discarding 3 of them.
+                    sc_attn_dict = { layer_idx: attn.narrow(0, BLOCK_SIZE, BLOCK_SIZE) 
+                                     for layer_idx, attn in ca_layers_activations['attn'].items() }
                     # Suppress the activation of the subject embeddings at the background area, to reduce double-face artifacts.
                     loss_comp_sc_subj_mb_suppress_step = \
                         calc_subj_masked_bg_suppress_loss(sc_attn_dict, all_subj_indices_1b, BLOCK_SIZE, sc_fg_mask)
@@ -2822,17 +2979,26 @@ class LatentDiffusion(DDPM):
 
             if arcface_loss_calc_count > 0:
                 loss_arcface_align_comp = loss_arcface_align_comp / arcface_loss_calc_count
-                loss_dict.update({f'{session_prefix}/arcface_align_comp': loss_arcface_align_comp.mean().detach().item() })
+                loss_comp_sc_subj_mb_suppress = loss_comp_sc_subj_mb_suppress / arcface_loss_calc_count
+                # Transfer both logged losses to the host in one go.
+                v_loss_arcface_align_comp, v_loss_comp_sc_subj_mb_suppress = \
+                    torch.stack([ loss_arcface_align_comp.mean().detach().float(), 
+                                  loss_comp_sc_subj_mb_suppress.mean().detach().float() ]).tolist()
+                loss_dict.update({f'{session_prefix}/arcface_align_comp': v_loss_arcface_align_comp })
                 self.comp_iters_face_detected_count += 1
                 comp_iters_face_detected_frac = self.comp_iters_face_detected_count / self.comp_iters_count
                 loss_dict.update({f'{session_prefix}/comp_iters_face_detected_frac': comp_iters_face_detected_frac})
-
-                loss_comp_sc_subj_mb_suppress = loss_comp_sc_subj_mb_suppress / arcface_loss_calc_count
-                loss_dict.update({f'{session_prefix}/comp_sc_subj_mb_suppress': loss_comp_sc_subj_mb_suppress.mean().detach().item() })
+                loss_dict.update({f'{session_prefix}/comp_sc_subj_mb_suppress': v_loss_comp_sc_subj_mb_suppress })
 
         return loss_arcface_align_comp, loss_comp_sc_subj_mb_suppress, \
                sc_fg_mask, sc_face_bboxes, sc_face_detected_at_step
     
+    # cache_and_log_generations() only runs on rank 0. So on other ranks, or in iterations
+    # that are not logged, the VAE decoding of the generations to be logged can be skipped.
+    def should_log_generations(self):
+        return self.trainer.is_global_zero \
+               and (self.global_step % self.log_generations_every_n_iters == 0)
+
     # samples: a single 4D [B, C, H, W] np array, or a single 4D [B, C, H, W] torch tensor, 
     # or a list of 3D [C, H, W] torch tensors.
     # Data type of samples could be uint (0-25), or float (-1, 1) or (0, 1).
@@ -2851,9 +3017,14 @@ class LatentDiffusion(DDPM):
             samples = torch.cat(samples, 0)
 
         if samples.dtype != torch.uint8:
+            # The first op is out-of-place, so that the caller's tensor is never modified.
+            # The rest run in-place on that copy, without allocating more full-batch intermediates.
+            # clamp((samples + 1) / 2, 0, 1) * 255 == clamp((samples + 1) * 127.5, 0, 255).
             if do_normalize:
-                samples = torch.clamp((samples + 1.0) / 2.0, min=0.0, max=1.0)
-            samples = (255. * samples).to(torch.uint8)
+                samples = samples.detach().add(1.0).mul_(127.5).clamp_(0, 255)
+            else:
+                samples = samples.detach().mul(255.)
+            samples = samples.to(torch.uint8)
 
         # img_colors is a 1D tensor: (B,)
         if img_colors is None:
@@ -2874,8 +3045,21 @@ class LatentDiffusion(DDPM):
             # samples:    a (B, C, H, W) tensor.
             # img_colors: a tensor of (B,) ints.
             # samples should be between [0, 255] (uint8).
-            asyncio.run(save_grid(cached_images, cached_img_colors, grid_filename, nrow=12))
-            print(f"{self.num_cached_generations} generations saved to {grid_filename}")
+            # Move to CPU here, so that the background thread never touches CUDA tensors 
+            # that may be overwritten by the training loop.
+            cached_images     = cached_images.cpu()
+            cached_img_colors = cached_img_colors.cpu()
+            if self.save_grid_executor is None:
+                self.save_grid_executor = ThreadPoolExecutor(max_workers=1)
+            # Wait for the previous grid to be written, so that at most one grid is pending.
+            # A grid is only saved every max_cache_size generations, so this almost never blocks.
+            if self.save_grid_future is not None:
+                self.save_grid_future.result()
+            # Drawing, make_grid and PNG encoding run in the background thread, 
+            # instead of blocking the training step.
+            self.save_grid_future = self.save_grid_executor.submit(save_grid_sync, cached_images, cached_img_colors, 
+                                                                   grid_filename, nrow=12)
+            print(f"{self.num_cached_generations} generations to be saved to {grid_filename}")
             
             # Clear the cache. If num_cached_generations > max_cache_size,
             # some samples at the end of the cache will be discarded.
@@ -2940,8 +3124,15 @@ class LatentDiffusion(DDPM):
                 opt = OptimizerClass(opt_params, lr=lr, weight_decay=self.weight_decay,
                                         betas=self.adam_config.betas)
             else:
+                # The fused AdamW kernel updates all the parameters in a few CUDA kernel launches, 
+                # instead of looping over the (many small) parameter tensors in Python.
+                # It requires all the parameters to be on the GPU.
+                # torch.optim.NAdam already uses the multi-tensor (foreach) path by default on CUDA.
+                optimizer_kwargs = {}
+                if self.optimizer_type == 'AdamW' and all(p.is_cuda for p in opt_params):
+                    optimizer_kwargs['fused'] = True
                 opt = OptimizerClass(opt_params_with_lrs, weight_decay=self.weight_decay,
-                                    betas=self.adam_config.betas)
+                                    betas=self.adam_config.betas, **optimizer_kwargs)
             assert 'target' in self.adam_config.scheduler_config
             self.adam_config.scheduler_config.params.max_decay_steps = self.trainer.max_steps
             lambda_scheduler = instantiate_from_config(self.adam_config.scheduler_config)
@@ -3055,21 +3246,26 @@ class LatentDiffusion(DDPM):
                 # The unet has different parameter names from diffusers.
                 # It can be converted with convert_ldm_unet_checkpoint().
 
-                state_dict = self.model.state_dict()
-                state_dict2 = {}
-                for k in state_dict:
-                    # Skip ema weights
-                    if k.startswith("model_ema."):
-                        continue    
-                    if state_dict[k].dtype == torch.float32:
-                        state_dict2[k] = state_dict[k].half()
-                    else:
-                        state_dict2[k] = state_dict[k]
+                # Skip ema weights, and cast fp32 tensors to fp16 to halve the file size.
+                # The other tensors (already fp16, or integer buffers) are saved as they are.
+                # The tensors are copied to CPU here, so that the training steps that follow 
+                # can update the UNet weights while the file is being written.
+                state_dict2 = { k: (v.half() if v.dtype == torch.float32 else v).detach().cpu()
+                                for k, v in self.model.state_dict().items() 
+                                if not k.startswith("model_ema.") }
 
                 unet_save_path = os.path.join(self.trainer.checkpoint_callback.dirpath, 
                                               f"unet-{self.global_step}.safetensors")
-                safetensors_save_file(state_dict2, unet_save_path)
-                print(f"Saved {unet_save_path}")
+                if self.save_ckpt_executor is None:
+                    self.save_ckpt_executor = ThreadPoolExecutor(max_workers=1)
+                # Wait for the previous checkpoint to be written, so that at most one 
+                # CPU copy of the UNet weights is pending.
+                if self.save_ckpt_future is not None:
+                    self.save_ckpt_future.result()
+                # The file is written in the background thread, instead of blocking training.
+                # The executor thread is joined at interpreter exit, so the last checkpoint is always completed.
+                self.save_ckpt_future = self.save_ckpt_executor.submit(safetensors_save_file, state_dict2, unet_save_path)
+                print(f"Saving {unet_save_path} in the background")
 
 # The old LDM UNet wrapper.
 class DiffusionWrapper(pl.LightningModule): 
@@ -3126,8 +3322,8 @@ class DiffusersUNetWrapper(pl.LightningModule):
             block.forward = CrossAttnUpBlock2D_forward_capture.__get__(block)
             block.res_hidden_states_stopgrad = res_hidden_states_stopgrad
         
-        for param in self.diffusion_model.parameters():
-            param.requires_grad = False
+        # Freeze the whole UNet. The LoRA params are set to trainable below.
+        self.diffusion_model.requires_grad_(False)
 
         if self.use_attn_lora or self.use_ffn_lora:
             # LoRA scaling is always 0.125, the same as the LoRAs in AttnProcessor_LoRA_Capture
@@ -3169,38 +3365,44 @@ class DiffusersUNetWrapper(pl.LightningModule):
             # with the prefix 'base_model_model_'. Because ffn_opt_modules are extracted from the peft-wrapped model,
             # and attn_opt_modules are extracted from the original unet model.
             # To be compatible with old param keys, we append 'base_model_model_' to the keys of attn_opt_modules.
-            unet_lora_modules.update({ f'base_model_model_{k}': v for k, v in attn_opt_modules.items() })
+            unet_lora_modules.update((f'base_model_model_{k}', v) for k, v in attn_opt_modules.items())
             unet_lora_modules.update(ffn_opt_modules)
             # ParameterDict can contain both Parameter and nn.Module.
             # TODO: maybe in the future, we couldn't put nn.Module in nn.ParameterDict.
             self.unet_lora_modules  = torch.nn.ParameterDict(unet_lora_modules)
-            for param in self.unet_lora_modules.parameters():
-                param.requires_grad = True
+            # requires_grad_() covers both the Parameter entries and the parameters of the module entries.
+            self.unet_lora_modules.requires_grad_(True)
             print(f"Set up LoRAs with {len(self.unet_lora_modules)} modules: {self.unet_lora_modules.keys()}")
         else:
             self.ffn_lora_layers    = []
             self.unet_lora_modules  = None
 
+        # The flags last applied by set_lora_and_capture_flags() in forward(). 
+        # None means unknown, as the attn processors are initialized with their own flags.
+        self.lora_and_capture_flags = None
+
     def forward(self, x, t, cond_context, out_dtype=torch.float32):
         prompt_emb, prompt_in, extra_info = cond_context
+        # Check extra_info against None only once. An empty dict yields the same defaults.
+        extra_info2  = extra_info if extra_info is not None else {}
         # img_mask is only used in normal_recon iterations. Not in unet distillation or comp distillation.
         # img_mask is used in BasicTransformerBlock.attn1 (self-attention of image tokens),
         # to avoid mixing the invalid blank areas around the augmented images with the valid areas.
         # img_mask is not used in the prompt-image cross-attention layers.
-        img_mask     = extra_info.get('img_mask', None) if extra_info is not None else None
-        subj_indices = extra_info.get('subj_indices', None) if extra_info is not None else None
+        img_mask     = extra_info2.get('img_mask', None)
+        subj_indices = extra_info2.get('subj_indices', None)
         # shrink_subj_attn is only set to the LoRA'ed attn layers, i.e., 
         # layers 22, 23, 24, and only takes effect when subj_indices is not None.
         # Other layers will always have shrink_subj_attn = False.
-        shrink_subj_attn = extra_info.get('shrink_subj_attn', False) if extra_info is not None else False
+        shrink_subj_attn = extra_info2.get('shrink_subj_attn', False)
         #print(subj_indices)
 
-        capture_ca_activations = extra_info.get('capture_ca_activations', False) if extra_info is not None else False
+        capture_ca_activations = extra_info2.get('capture_ca_activations', False)
         # self.use_attn_lora and self.use_ffn_lora are the global flag. 
         # We can override them by setting extra_info['use_attn_lora'] and extra_info['use_ffn_lora'].
         # If use_attn_lora is set to False globally, then disable it in this call.
-        use_attn_lora = extra_info.get('use_attn_lora', self.use_attn_lora) if extra_info is not None else self.use_attn_lora
-        use_ffn_lora  = extra_info.get('use_ffn_lora',  self.use_ffn_lora)  if extra_info is not None else self.use_ffn_lora
+        use_attn_lora = extra_info2.get('use_attn_lora', self.use_attn_lora)
+        use_ffn_lora  = extra_info2.get('use_ffn_lora',  self.use_ffn_lora)
 
         # set_lora_and_capture_flags() accesses self.attn_capture_procs, self.ffn_lora_layers, 
         # and self.outfeat_capture_blocks.
@@ -3211,8 +3413,13 @@ class DiffusersUNetWrapper(pl.LightningModule):
         # use_attn_lora, capture_ca_activations, shrink_subj_attn are only applied to layers 
         # in self.attn_capture_procs.
         # use_ffn_lora is only applied to layers in self.ffn_lora_layers.
-        set_lora_and_capture_flags(self.attn_capture_procs, self.outfeat_capture_blocks, self.ffn_lora_layers, 
-                                   use_attn_lora, use_ffn_lora, capture_ca_activations, shrink_subj_attn)
+        # The flags are restored to all False at the end of each call. So if this call uses 
+        # the same flags as the current ones (typically all False), we don't need to set them again.
+        lora_and_capture_flags = (use_attn_lora, use_ffn_lora, capture_ca_activations, shrink_subj_attn)
+        if lora_and_capture_flags != self.lora_and_capture_flags:
+            set_lora_and_capture_flags(self.attn_capture_procs, self.outfeat_capture_blocks, self.ffn_lora_layers, 
+                                       use_attn_lora, use_ffn_lora, capture_ca_activations, shrink_subj_attn)
+            self.lora_and_capture_flags = lora_and_capture_flags
 
         # x: x_noisy from LatentDiffusion.apply_model().
         x, prompt_emb, img_mask = [ ts.to(self.dtype) if ts is not None else None \
@@ -3238,9 +3445,13 @@ class DiffusersUNetWrapper(pl.LightningModule):
 
         # Restore capture_ca_activations to False, and disable all loras.
         # set_lora_and_capture_flags() accesses self.attn_capture_procs, self.ffn_lora_layers, 
-        # and self.outfeat_capture_blocks.        
-        set_lora_and_capture_flags(self.attn_capture_procs, self.outfeat_capture_blocks, self.ffn_lora_layers, 
-                                   False, False, False)
+        # and self.outfeat_capture_blocks.
+        # If all the flags are already False, then no activations have been cached in this call,
+        # and there's nothing to restore.
+        if lora_and_capture_flags != (False, False, False, False):
+            set_lora_and_capture_flags(self.attn_capture_procs, self.outfeat_capture_blocks, self.ffn_lora_layers, 
+                                       False, False, False)
+        self.lora_and_capture_flags = (False, False, False, False)
 
         out = out.to(out_dtype)
         return out
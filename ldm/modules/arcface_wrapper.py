@@ -37,6 +37,8 @@ class ArcFaceWrapper(nn.Module):
 
         self.retinaface = RetinaFaceClient(device=device)
         # We keep retinaface at float32, as it doesn't require grad and won't consume much memory.
+        # The detected bboxes also crop the pixel-space faces for the arcface embeddings, and 
+        # float16 could change which faces pass the confidence threshold. So use_fp16 is not enabled.
         self.retinaface.eval()
 
         for param in self.arcface.parameters():
@@ -93,6 +95,9 @@ class ArcFaceWrapper(nn.Module):
             embs1 = embs1.repeat(len(embs2)//len(embs1), 1)
         
         # labels = 1: align the embeddings of the same person.
-        arcface_align_loss = F.cosine_embedding_loss(embs1, embs2, torch.ones(embs1.shape[0]).to(embs1.device))
+        # The arcface embeddings are in self.dtype (float16). Compute the loss in float32, 
+        # so that the loss accumulated with other float32 losses doesn't lose precision.
+        arcface_align_loss = F.cosine_embedding_loss(embs1.float(), embs2.float(), 
+                                                     torch.ones(embs1.shape[0], device=embs1.device))
         print(f"Arcface align loss: {arcface_align_loss.item():.2f}")
         return arcface_align_loss, face_coords
@@ -45,11 +45,12 @@ def log_txt_as_img(wh, xc, size=10):
     # xc a list of captions to plot
     b = len(xc)
     txts = list()
+    # The font and the line width are the same for all captions.
+    font = ImageFont.load_default()
+    nc = int(40 * (wh[0] / 256))
     for bi in range(b):
         txt = Image.new("RGB", wh, color="white")
         draw = ImageDraw.Draw(txt)
-        font = ImageFont.load_default()
-        nc = int(40 * (wh[0] / 256))
         lines = "\n".join(xc[bi][start:start + nc] for start in range(0, len(xc[bi]), nc))
 
         try:
@@ -57,10 +58,11 @@ def log_txt_as_img(wh, xc, size=10):
         except UnicodeEncodeError:
             print("Cant encode string for logging. Skipping.")
 
-        txt = np.array(txt).transpose(2, 0, 1) / 127.5 - 1.0
-        txts.append(txt)
-    txts = np.stack(txts)
-    txts = torch.tensor(txts)
+        # Keep the uint8 HWC images, and normalize them all at once after the loop.
+        txts.append(np.asarray(txt))
+    # [B, H, W, 3] => [B, 3, H, W], in [-1, 1].
+    txts = np.ascontiguousarray(np.stack(txts).transpose(0, 3, 1, 2) / 127.5 - 1.0)
+    txts = torch.from_numpy(txts)
     return txts
 
 def ismap(x):
@@ -344,11 +346,15 @@ def ortho_subtract(a, b, b_discount=1, on_last_n_dims=1, return_align_coeffs=Fal
         a2 = a
         b2 = b
 
-    dot_a_b = (a2 * b2).sum(dim=-1)
-    dot_b_b = (b2 * b2).sum(dim=-1)
+    # keepdim=True, so that w_optimal broadcasts against b2 without an extra unsqueeze.
+    dot_a_b = (a2 * b2).sum(dim=-1, keepdim=True)
+    dot_b_b = (b2 * b2).sum(dim=-1, keepdim=True)
 
     w_optimal = dot_a_b / (dot_b_b + 1e-6)
-    result = a2 - b2 * w_optimal.unsqueeze(-1) * b_discount
+    # b_discount is applied to the (small) coefficients, and addcmul computes 
+    # a2 - b2 * coeffs in one kernel, instead of three full-size elementwise ops.
+    result = torch.addcmul(a2, b2, w_optimal * b_discount, value=-1)
+    w_optimal = w_optimal.squeeze(-1)
 
     if on_last_n_dims > 1:
         result = result.reshape(orig_shape)
@@ -383,104 +389,84 @@ def calc_ref_cosine_loss(delta, ref_delta, emb_mask=None,
                          reduction='mean', debug=False):
 
     B = delta.shape[0]
-    loss = 0
-    losses = []
-
-    # Calculate the loss for each sample in the batch, 
-    # as the mask may be different for each sample.
-    for i in range(B):
-        # Keep the batch dimension when dealing with the i-th sample, so that
-        # we don't need to mess with first_n_dims_into_instances.
-        delta_i     = delta[[i]]
-        ref_delta_i = ref_delta[[i]]
-        emb_mask_i  = emb_mask[[i]] if emb_mask is not None else None
-
-        # Remove useless tokens, e.g., the placeholder suffix token(s) and padded tokens.
-        if emb_mask_i is not None:
-            try:
-                # delta_i_flattened_dims_shape: [1, 77, 768]
-                delta_i_flattened_dims_shape = delta_i.shape[:first_n_dims_into_instances]
-                # truncate_mask: [1, 77].
-                truncate_mask = (emb_mask_i > 0).squeeze(-1).expand(delta_i_flattened_dims_shape)
-                # delta_i: [1, 77, 768] => [58, 768].
-                delta_i       = delta_i[truncate_mask]
-                ref_delta_i   = ref_delta_i[truncate_mask]
-                # Make emb_mask_i have the same shape as delta_i, 
-                # except the last (embedding) dimension for computing the cosine loss.
-                # delta_i: [1, 20, 768]. 
-                # emb_mask_i: [1, 77, 1] => [1, 77] => [58]
-                # Expanding to same shape is necessary, since the cosine of each embedding has an 
-                # individual weight (no broadcasting happens).
-                emb_mask_i    = emb_mask_i.squeeze(-1).expand(delta_i_flattened_dims_shape)[truncate_mask]
-            except:
-                breakpoint()
-
-        else:
-            # Flatten delta and ref_delta, by tucking the token dimensions into the batch dimension.
-            # delta_i: [2464, 768], ref_delta_i: [2464, 768]
-            delta_i     = delta_i.reshape(delta_i.shape[:first_n_dims_into_instances].numel(), -1)
-            ref_delta_i = ref_delta_i.reshape(delta_i.shape)
-            # emb_mask_i should have first_n_dims_into_instances dims before flattening.
-            emb_mask_i  = emb_mask_i.flatten() if emb_mask_i is not None else None
-
-        # A bias vector to a set of conditioning embeddings doesn't change the attention matrix 
-        # (though changes the V tensor). So the bias is better removed.
-        # Therefore, do demean() before cosine loss, 
-        # to remove the effect of bias.
-        # In addition, different ada layers have significantly different scales. 
-        # But since cosine is scale invariant, de-scale is not necessary and won't have effects.
-        # LN = demean & de-scale. So in theory, LN is equivalent to demean() here. But LN may introduce
-        # numerical instability. So we use simple demean() here.
+    # All the samples in the batch are processed at once. Instead of removing the masked-out tokens
+    # (whose number may differ across samples), their losses are zeroed out by emb_mask below,
+    # which gives the same per-sample mean losses.
+    # delta_flattened_dims_shape: [B, 77] (if first_n_dims_into_instances == 2).
+    delta_flattened_dims_shape = delta.shape[:first_n_dims_into_instances]
+    # N: the number of instances in each sample.
+    N = delta_flattened_dims_shape[1:].numel()
+    # Flatten delta and ref_delta, by tucking the token dimensions into the batch dimension.
+    # delta_flat: [B*N, 768], ref_delta_flat: [B*N, 768].
+    delta_flat     = delta.reshape(B * N, -1)
+    ref_delta_flat = ref_delta.reshape(B * N, -1)
+
+    if emb_mask is not None:
+        # Make emb_mask have the same shape as delta, except the last (embedding) dimension 
+        # for computing the cosine loss.
+        # emb_mask: [B, 77, 1] => [B, 77] => [B, N].
+        # Expanding to same shape is necessary, since the cosine of each embedding has an 
+        # individual weight (no broadcasting happens).
+        emb_mask = emb_mask.squeeze(-1).expand(delta_flattened_dims_shape).reshape(B, N)
+
+    # A bias vector to a set of conditioning embeddings doesn't change the attention matrix 
+    # (though changes the V tensor). So the bias is better removed.
+    # Therefore, do demean() before cosine loss, 
+    # to remove the effect of bias.
+    # In addition, different ada layers have significantly different scales. 
+    # But since cosine is scale invariant, de-scale is not necessary and won't have effects.
+    # LN = demean & de-scale. So in theory, LN is equivalent to demean() here. But LN may introduce
+    # numerical instability. So we use simple demean() here.
 
-        if debug:
-            breakpoint()
+    if debug:
+        breakpoint()
 
-        if do_demeans[0]:
-            delta_i      = demean(delta_i)
-        if do_demeans[1]:
-            ref_delta_i2 = demean(ref_delta_i)
-        else:
-            ref_delta_i2 = ref_delta_i
-
-        # x * x.abs.pow(exponent - 1) will keep the sign of x after pow(exponent).
-        grad_scaler = gen_gradient_scaler(ref_grad_scale)
-        ref_delta_i2 = grad_scaler(ref_delta_i2)
-
-        ref_delta_i_pow = ref_delta_i2 * ref_delta_i2.abs().pow(exponent - 1)
-
-        # If not aim_to_align, then cosine_label = -1, i.e., the cosine loss will 
-        # push delta_i to be orthogonal with ref_delta_i.
-        cosine_label = 1 if aim_to_align else -1
-        # losses_i: 1D tensor of losses for each embedding.
-        # F.cosine_embedding_loss() computes the cosines of each pair of instance
-        # in delta_i and ref_delta_i. 
-        # Each cosine is invariant to the scale of the corresponding two instances.
-        losses_i = F.cosine_embedding_loss(delta_i, ref_delta_i_pow, 
-                                           torch.ones_like(delta_i[:, 0]) * cosine_label, 
-                                           reduction='none')
-        # emb_mask_i has been flatten to 1D. So it gives different embeddings 
-        # different relative weights (after normalization).
-        if emb_mask_i is not None:
-            losses_i = losses_i * emb_mask_i
-
-        if reduction == 'mean':
-            if emb_mask_i is not None:
-                loss_i = losses_i.sum() / (emb_mask_i.sum() + 1e-8)
-            else:
-                loss_i = losses_i.mean()
+    if do_demeans[0]:
+        delta_flat      = demean(delta_flat)
+    if do_demeans[1]:
+        ref_delta_flat2 = demean(ref_delta_flat)
+    else:
+        ref_delta_flat2 = ref_delta_flat
+
+    # x * x.abs.pow(exponent - 1) will keep the sign of x after pow(exponent).
+    grad_scaler = gen_gradient_scaler(ref_grad_scale)
+    ref_delta_flat2 = grad_scaler(ref_delta_flat2)
+
+    ref_delta_pow = ref_delta_flat2 * ref_delta_flat2.abs().pow(exponent - 1)
+
+    # cosines: [B*N] => [B, N], the cosines of each pair of instance in delta_flat and ref_delta_pow. 
+    # Each cosine is invariant to the scale of the corresponding two instances.
+    cosines = F.cosine_similarity(delta_flat, ref_delta_pow, dim=-1).reshape(B, N)
+    # The losses below are the same as F.cosine_embedding_loss() with labels of all 1 or all -1 
+    # (margin = 0), without allocating the label tensor.
+    # If not aim_to_align (cosine_label = -1), then the cosine loss will 
+    # push delta to be orthogonal with ref_delta.
+    if aim_to_align:
+        losses = 1 - cosines
+    else:
+        losses = cosines.clamp(min=0)
+    # emb_mask gives different embeddings different relative weights (after normalization),
+    # and zeroes out the losses of the masked-out embeddings.
+    if emb_mask is not None:
+        losses = losses * emb_mask
 
-            loss += loss_i
-        elif reduction == 'none':
-            losses.append(losses_i)
-        else:
-            breakpoint()
-            
     if reduction == 'mean':
-        loss = loss / B
+        if emb_mask is not None:
+            # The mean loss of each sample, weighted by emb_mask.
+            loss = losses.sum(dim=1) / (emb_mask.sum(dim=1) + 1e-8)
+            loss = loss.mean()
+        else:
+            # All samples have the same number of instances, 
+            # so the mean of the sample means is the mean of all losses.
+            loss = losses.mean()
         return loss
-    else:
-        losses = torch.stack(losses, dim=0)
+    elif reduction == 'none':
+        if emb_mask is not None:
+            # Only keep the losses of the embeddings that are not masked out, as before.
+            losses = torch.stack([ losses[i][emb_mask[i] > 0] for i in range(B) ], dim=0)
         return losses
+    else:
+        breakpoint()
 
 # feat_base, feat_ex, ...: [2, 9, 1280].
 # Last dim is the channel dim.
@@ -539,10 +525,11 @@ def calc_and_print_stats(ts, ts_name=None):
 def rand_like(x):
     # Collapse all dimensions except the last one (channel dimension).
     x_2d = x.reshape(-1, x.shape[-1])
-    std = x_2d.std(dim=0, keepdim=True)
-    mean = x_2d.mean(dim=0, keepdim=True)
+    # std_mean() computes both statistics in one reduction.
+    std, mean = torch.std_mean(x_2d, dim=0, keepdim=True)
     rand_2d = torch.randn_like(x_2d)
-    rand_2d = rand_2d * std + mean
+    # rand_2d is freshly allocated, so it can be scaled and shifted in-place.
+    rand_2d.mul_(std).add_(mean)
     return rand_2d.view(x.shape)
 
 def rand_dropout(x, p=0.5):
@@ -567,13 +554,6 @@ def distribute_embedding_to_M_tokens(text_embedding, placeholder_indices_N, divi
     
     # Location of the first embedding in a multi-embedding token.
     placeholder_indices_N0 = placeholder_indices_N[:1]
-    # text_embedding, repl_text_embedding: [16, 77, 768].
-    # Use (:, placeholder_indices_N) as index, so that we can index all 16 embeddings at the same time.
-    repl_mask = torch.zeros_like(text_embedding)
-    # Almost 0 everywhere, except those corresponding to the multi-embedding token.
-    repl_mask[:, placeholder_indices_N] = 1
-    repl_text_embedding = torch.zeros_like(text_embedding)
-    # Almost 0 everywhere, except being the class embedding at locations of the multi-embedding token.
     # Repeat M times the class embedding (corresponding to the subject embedding 
     # "z" at placeholder_indices_N0); 
     # Divide them by D to avoid the cross-attention over-focusing on the class-level subject.
@@ -586,11 +566,17 @@ def distribute_embedding_to_M_tokens(text_embedding, placeholder_indices_N, divi
 
     # Use only the first embedding of the multi-embedding token, and distribute it to the rest M-1 embeddings.
     # The first embedding should be the sum of a multi-token cls embeddings.
-    repl_text_embedding[:, placeholder_indices_N] = text_embedding[:, placeholder_indices_N0].repeat(1, M, 1) / D
+    # text_embedding: [16, 77, 768]. repl_text_embedding: [16, M, 768].
+    # Use (:, placeholder_indices_N0) as index, so that we can index all 16 embeddings at the same time.
+    repl_text_embedding = text_embedding[:, placeholder_indices_N0].expand(-1, M, -1) / D
 
     # Keep the embeddings at almost everywhere, but only replace the embeddings at placeholder_indices_N.
-    # Directly replacing by slicing with placeholder_indices_N will cause errors.
-    patched_text_embedding = text_embedding * (1 - repl_mask) + repl_text_embedding * repl_mask
+    # Directly replacing by slicing text_embedding in-place with placeholder_indices_N will cause errors
+    # in autograd. index_copy() is out-of-place: it copies text_embedding once and only writes the M 
+    # replaced embeddings, instead of blending full-size masks.
+    # Unlike advanced indexing, index_copy() requires the indices to be on the same device.
+    patched_text_embedding = text_embedding.index_copy(1, placeholder_indices_N.to(text_embedding.device), 
+                                                       repl_text_embedding)
     return patched_text_embedding
 
 def distribute_embedding_to_M_tokens_by_dict(text_embedding, placeholder_indices_dict, divide_scheme='sqrt_M'):
@@ -1253,11 +1239,15 @@ def resize_mask_to_target_size(mask, mask_name, target_spatial_area, mode="neare
 # masks = select_and_repeat_instances(slice(0, BLOCK_SIZE), 4, img_mask, fg_mask)
 # Don't call like:
 # masks = select_and_repeat_instances(slice(0, BLOCK_SIZE), 4, (img_mask, fg_mask))
-def select_and_repeat_instances(sel_indices, REPEAT, *args):
+# as_view: if the selected tensor has a single instance, return an expanded view instead of
+# repeated copies. Only use it when the returned tensors are never modified in place.
+def select_and_repeat_instances(sel_indices, REPEAT, *args, as_view=False):
     rep_args = []
     for arg in args:
         if arg is not None:
-            if isinstance(arg, (torch.Tensor, np.ndarray)):
+            if as_view and isinstance(arg, torch.Tensor) and arg[sel_indices].shape[0] == 1:
+                arg2 = arg[sel_indices].expand([REPEAT] + [-1] * (arg.ndim - 1))
+            elif isinstance(arg, (torch.Tensor, np.ndarray)):
                 arg2 = arg[sel_indices].repeat([REPEAT] + [1] * (arg.ndim - 1))
             elif isinstance(arg, (list, tuple)):
                 arg2 = arg[sel_indices] * REPEAT
@@ -1481,9 +1471,27 @@ def pixel_bboxes_to_latent(pixel_bboxes, W, latent_W):
     # pixel_bboxes are coords on ss_x_recon_pixels, 512*512.
     # However, fg_mask is on the latents, 64*64. 
     # Therefore, we need to scale them down by 8.
-    pixel_bboxes = pixel_bboxes * latent_W // W
+    # If W is a multiple of latent_W (always true for the SD VAE), a single floor division 
+    # gives the same integer coords as (pixel_bboxes * latent_W) // W, without the multiplication.
+    if W % latent_W == 0:
+        pixel_bboxes = pixel_bboxes // (W // latent_W)
+    else:
+        pixel_bboxes = pixel_bboxes * latent_W // W
     return pixel_bboxes
 
+# bboxes: long tensor of [B, 4], each row is (x1, y1, x2, y2) on an H*W grid.
+# pad: expand each bbox by pad pixels on each side (clipped by the image borders).
+# Return a [B, 1, H, W] mask, which is 1 within the bboxes and 0 elsewhere.
+# All boxes are rasterized at once on the device of bboxes, 
+# without reading the coords back to the host.
+def bboxes_to_mask(bboxes, H, W, pad=0, dtype=torch.float32):
+    x1, y1, x2, y2 = [ coord.view(-1, 1, 1, 1) for coord in bboxes.unbind(dim=1) ]
+    # ys: [1, 1, H, 1], xs: [1, 1, 1, W].
+    ys = torch.arange(H, device=bboxes.device).view(1, 1, H, 1)
+    xs = torch.arange(W, device=bboxes.device).view(1, 1, 1, W)
+    mask = (ys >= y1 - pad) & (ys < y2 + pad) & (xs >= x1 - pad) & (xs < x2 + pad)
+    return mask.to(dtype)
+
 # At scaled background, fill new x_start with random values (100% noise). 
 # At scaled foreground, fill new x_start with noised scaled x_start. 
 def init_x_with_fg_from_training_image(x_start, fg_mask, 
@@ -1725,9 +1733,9 @@ def calc_subj_masked_bg_suppress_loss(ca_attn, subj_indices, BLOCK_SIZE, fg_mask
                                               mode="nearest|bilinear")
         # Repeat 8 times to match the number of attention heads (for normalization).
         fg_mask2 = fg_mask2.reshape(BLOCK_SIZE, 1, -1).repeat(1, subj_attn.shape[1], 1)
-        fg_mask3 = torch.zeros_like(fg_mask2)
-        # Set fractional values (due to resizing) to 1.
-        fg_mask3[fg_mask2 >  1e-6] = 1.
+        # Set fractional values (due to resizing) to 1, and the rest to 0.
+        # Binarize in one op, instead of zero-initializing and then filling in place.
+        fg_mask3 = (fg_mask2 > 1e-6).to(fg_mask2.dtype)
 
         bg_mask3 = (1 - fg_mask3)
 
@@ -1892,11 +1900,25 @@ def calc_comp_subj_bg_preserve_loss(loss_dict, session_prefix,
     loss_sc_to_mc_sparse_attns_distill, loss_comp_subj_bg_attn_suppress \
         = [ loss_dict.get(loss_name, 0) for loss_name in effective_loss_names ] 
 
+    # Transfer all the logged tensor values to the host in one go, 
+    # instead of syncing with the GPU on each comparison and .item().
+    tensor_loss_names = [ loss_name for loss_name in loss_names \
+                          if loss_name in loss_dict and torch.is_tensor(loss_dict[loss_name]) ]
+    if len(tensor_loss_names) > 0:
+        tensor_loss_values = torch.stack([ loss_dict[loss_name].mean().detach().float() 
+                                           for loss_name in tensor_loss_names ]).tolist()
+    else:
+        tensor_loss_values = []
+    log_values = dict(zip(tensor_loss_names, tensor_loss_values))
+
     for loss_name in loss_names:
-        if loss_name in loss_dict and loss_dict[loss_name] > 0:
+        if loss_name not in loss_dict:
+            continue
+        log_value = log_values.get(loss_name, loss_dict[loss_name])
+        if log_value > 0:
             loss_name2 = loss_name.replace('loss_', '')
             # Accumulate the loss values to loss_dict when there are multiple denoising steps.
-            add_dict_to_dict(loss_dict, {f'{session_prefix}/{loss_name2}': loss_dict[loss_name].mean().detach().item() })
+            add_dict_to_dict(loss_dict, {f'{session_prefix}/{loss_name2}': log_value })
 
     # loss_comp_subj_bg_attn_suppress: 0.01~0.02 -> 0.0002~0.0004.
     comp_subj_bg_attn_suppress_loss_scale       = 0.02
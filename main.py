@@ -244,6 +244,11 @@ def get_parser(**parser_kwargs):
     parser.add_argument("--prompt_emb_delta_reg_weight", type=float, default=argparse.SUPPRESS,
                         help="Prompt delta regularization weight")
 
+    parser.add_argument("--log_generations_every_n_iters", type=int, default=argparse.SUPPRESS,
+                        help="Decode and log the generated images every n iterations")
+    parser.add_argument("--compile_frozen_unets", type=str2bool, nargs="?", const=True, default=argparse.SUPPRESS,
+                        help="Compile the frozen unet teacher and the comp distillation priming unet with torch.compile")
+
     parser.add_argument("--rand_scale_range", type=float, nargs=2, default=[0.4, 1.0],
                         help="Range of random scaling on training images (set to `1 1` to disable)")
 
@@ -371,7 +376,8 @@ class DataModuleFromConfig(pl.LightningDataModule):
                           shuffle=shuffle, sampler=sampler,
                           num_workers=self.num_workers, 
                           worker_init_fn=init_fn, drop_last=True,
-                          pin_memory=False)
+                          # Pinned batches are copied to the GPU asynchronously.
+                          pin_memory=True)
 
     def _test_dataloader(self, shuffle=False):
         if self.use_worker_init_fn:
@@ -584,6 +590,8 @@ if __name__ == "__main__":
         torch.backends.cudnn.deterministic = True
         torch.backends.cudnn.benchmark = False
 
+    # cudnn.benchmark is enabled by "lightning.trainer.benchmark: True" in the training configs.
+    # Enable TF32 for matmuls in the UNet and VAE.
     torch.backends.cuda.matmul.allow_tf32 = True
 
     '''    
@@ -719,6 +727,10 @@ if __name__ == "__main__":
         config.model.params.q_lora_updates_query = opt.q_lora_updates_query
         if hasattr(opt, 'cls_subj_mix_scheme'):
             config.model.params.cls_subj_mix_scheme = opt.cls_subj_mix_scheme
+        if hasattr(opt, 'log_generations_every_n_iters'):
+            config.model.params.log_generations_every_n_iters = opt.log_generations_every_n_iters
+        if hasattr(opt, 'compile_frozen_unets'):
+            config.model.params.compile_frozen_unets = opt.compile_frozen_unets
             
         # data: DataModuleFromConfig
         data = instantiate_from_config(config.data)